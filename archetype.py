@@ -0,0 +1,163 @@
+"""
+Archetype based entity storage.
+
+An archetype is the set of component types (component.add_as)
+an entity has. Entities with the same archetype are stored together,
+so a query for some component types only needs to look at
+matching archetypes, not at every entity.
+"""
+from collections import OrderedDict
+
+from util import sort_ordered
+
+
+class Archetype(object):
+    def __init__(self, key):
+        # frozenset of component types
+        self.key = key
+        # Entities in this archetype, in the order they were added
+        self.entities = OrderedDict()
+        # Bumped whenever an entity enters or leaves
+        self.version = 0
+        # Component type: archetype reached by adding/removing it
+        self.add_edges = {}
+        self.remove_edges = {}
+        # Free for users of the index to cache per archetype data
+        # (e.g. which systems its entities need)
+        self.data = {}
+
+    def add(self, entity):
+        self.entities[entity] = None
+        self.version += 1
+
+    def remove(self, entity):
+        del self.entities[entity]
+        self.version += 1
+
+    def sort(self, key):
+        sort_ordered(self.entities, key)
+        self.version += 1
+
+    def matches(self, component_types):
+        return self.key.issuperset(component_types)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __repr__(self):
+        return 'Archetype({})'.format(
+            ', '.join(sorted(t.__name__ for t in self.key)))
+
+
+class ArchetypeIndex(object):
+    """
+    Keeps every entity in the archetype of its current components.
+
+    query() results are cached. The list of archetypes matching a
+    query is extended when a new archetype is created, and the entity
+    list is rebuilt only when one of those archetypes changed.
+    """
+
+    def __init__(self):
+        # key: Archetype, in creation order
+        self.archetypes = OrderedDict()
+        # entity: Archetype
+        self.entity_archetype = {}
+        # frozenset(component types): [matching archetypes]
+        self._matching = {}
+        # frozenset(component types): (archetype versions, [entities])
+        self._results = {}
+
+    def _get(self, key):
+        try:
+            return self.archetypes[key]
+        except KeyError:
+            pass
+        archetype = Archetype(key)
+        self.archetypes[key] = archetype
+        for component_types, matching in self._matching.items():
+            if archetype.matches(component_types):
+                matching.append(archetype)
+        return archetype
+
+    def add(self, entity):
+        archetype = self._get(frozenset(entity.components))
+        archetype.add(entity)
+        self.entity_archetype[entity] = archetype
+        return archetype
+
+    def remove(self, entity):
+        self.entity_archetype.pop(entity).remove(entity)
+
+    def archetype(self, entity):
+        return self.entity_archetype[entity]
+
+    def component_added(self, entity, component_type):
+        """
+        Move entity to the archetype with component_type added.
+        """
+        current = self.entity_archetype[entity]
+        if component_type in current.key:
+            return current
+        try:
+            target = current.add_edges[component_type]
+        except KeyError:
+            target = self._get(current.key | frozenset([component_type]))
+            current.add_edges[component_type] = target
+            target.remove_edges[component_type] = current
+        return self._move(entity, current, target)
+
+    def component_removed(self, entity, component_type):
+        """
+        Move entity to the archetype with component_type removed.
+        """
+        current = self.entity_archetype[entity]
+        if component_type not in current.key:
+            return current
+        try:
+            target = current.remove_edges[component_type]
+        except KeyError:
+            target = self._get(current.key - frozenset([component_type]))
+            current.remove_edges[component_type] = target
+            target.add_edges[component_type] = current
+        return self._move(entity, current, target)
+
+    def _move(self, entity, current, target):
+        current.remove(entity)
+        target.add(entity)
+        self.entity_archetype[entity] = target
+        return target
+
+    def matching(self, *component_types):
+        """
+        Return a list of archetypes having all given component types.
+        """
+        component_types = frozenset(component_types)
+        try:
+            return self._matching[component_types]
+        except KeyError:
+            matching = [a for a in self.archetypes.values()
+                        if a.matches(component_types)]
+            self._matching[component_types] = matching
+            return matching
+
+    def query(self, *component_types):
+        """
+        Return a list of entities having all given component types.
+        With no component types, returns every entity.
+        Don't modify the returned list, it is shared between calls.
+        """
+        matching = self.matching(*component_types)
+        versions = [a.version for a in matching]
+        key = frozenset(component_types)
+        try:
+            cached_versions, entities = self._results[key]
+            if cached_versions == versions:
+                return entities
+        except KeyError:
+            pass
+        entities = []
+        for archetype in matching:
+            entities.extend(archetype.entities)
+        self._results[key] = (versions, entities)
+        return entities
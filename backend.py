@@ -0,0 +1,68 @@
+"""
+Picks the implementation of everything components need from
+cocos/pyglet: the real ones, or the stand-ins in headless.py when
+running headless.
+
+Headless mode is on when config.HEADLESS is set before this module
+is first imported, or when the COMPY_HEADLESS environment variable
+is set to anything but an empty string.
+"""
+import os
+
+import config
+
+HEADLESS = bool(config.HEADLESS or os.environ.get('COMPY_HEADLESS'))
+
+if HEADLESS:
+    from headless import (director, Sprite, Rect, Vector2, AARectShape,
+                          BatchNode, keycode, load_image, preload_images)
+    draw = batch = None
+else:
+    from cocos.director import director
+    from cocos.sprite import Sprite
+    from cocos.rect import Rect
+    from cocos.euclid import Vector2
+    from cocos.collision_model import AARectShape
+    from cocos.batch import BatchNode
+    from cocos import draw, batch
+    from pyglet.window import key as keycode
+    from pyglet.image import atlas as pyglet_atlas
+    import pyglet
+
+    # name: image, each image is loaded and uploaded once per process
+    images = {}
+    # Images are packed in as few textures as possible, sprites
+    # sharing a texture and a BatchNode are drawn in one call
+    atlas = pyglet_atlas.TextureBin(2048, 2048)
+
+    def load_image(name):
+        """
+        Return image with given name from pyglet.resource.path,
+        packed in the atlas.
+        """
+        try:
+            return images[name]
+        except KeyError:
+            pass
+        f = pyglet.resource.file(name)
+        try:
+            image = pyglet.image.load(name, file=f)
+        finally:
+            f.close()
+        try:
+            image = atlas.add(image)
+        except pyglet_atlas.AllocatorException:
+            # Larger than an atlas, gets a texture of its own
+            image = image.get_texture()
+        images[name] = image
+        return image
+
+    def preload_images():
+        """
+        Load every PNG in pyglet.resource.path, so they are packed
+        together before the first sprite is drawn.
+        """
+        for directory in pyglet.resource.path:
+            for name in sorted(os.listdir(directory)):
+                if name.endswith('.png'):
+                    load_image(name)
@@ -0,0 +1,229 @@
+"""
+Run many headless worlds at once, e.g. to tune AI parameters.
+
+Worlds are split between worker processes. Each worker builds its
+worlds and steps them in lockstep, one tick of every world at a time,
+sending metrics back over a pipe every few ticks. A world's seed is
+derived from the base seed and its repeat number, so every parameter
+combination is tried on the same levels, and any world can be run
+again on its own with the same result.
+
+    python -m batch --level stress --ticks 3600 --workers 8 \\
+        --param max_walk_speed=384,512,640 --repeats 10 > results.jsonl
+
+Prints one JSON line per world every --every ticks, in the order
+they arrive.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import random
+import select
+import sys
+import traceback
+
+import config
+# Before anything imports backend
+config.HEADLESS = True
+
+from benchmarks.levels import StressLevel
+from component import *
+import level
+from util import distance
+
+try:
+    from multiprocessing.connection import wait
+except ImportError:
+    # Python 2, Unix only
+    def wait(connections, timeout=None):
+        return select.select(connections, [], [], timeout)[0]
+
+
+class BatchError(Exception):
+    """
+    A worker failed, the message is its traceback.
+    """
+
+
+def level0(seed, ai_params, **kwargs):
+    return level.Level0(rand=random.Random(seed), ai_params=ai_params,
+                        **kwargs)
+
+
+def stress(seed, ai_params, **kwargs):
+    return StressLevel(seed=seed, ai_params=ai_params, **kwargs)
+
+
+# Level name: function(seed, ai_params, **kwargs) building it
+LEVELS = {'level0': level0, 'stress': stress}
+
+
+def world_seed(base_seed, repeat):
+    """
+    Return the seed of worlds of given repeat number, the same
+    on every run and every platform.
+    """
+    digest = hashlib.sha1('{}:{}'.format(base_seed, repeat)).hexdigest()
+    return int(digest[:8], 16)
+
+
+def make_specs(level_name, base_seed=0, param_grid=None, repeats=1,
+               level_kwargs=None):
+    """
+    Return a list of world specs, repeats worlds for every
+    combination of the values in param_grid ({name: [values]}).
+    Repeat i of every combination has the same seed.
+    """
+    param_grid = param_grid or {}
+    names = sorted(param_grid)
+    combinations = list(itertools.product(
+        *[param_grid[name] for name in names]))
+    specs = []
+    for values in combinations:
+        for i in range(repeats):
+            specs.append({'index': len(specs),
+                          'level': level_name,
+                          'seed': world_seed(base_seed, i),
+                          'ai_params': dict(zip(names, values)),
+                          'kwargs': level_kwargs or {}})
+    return specs
+
+
+def build_world(spec):
+    return LEVELS[spec['level']](spec['seed'], spec['ai_params'],
+                                 **spec['kwargs'])
+
+
+def world_metrics(world):
+    """
+    Return a dict of numbers describing how world is doing.
+    """
+    manager = world.systems_manager
+    player = world.player.component(Spatial).center
+    alive = [e for e in world.enemies if e in manager.systems]
+    distances = [distance(player, e.component(Spatial).center)
+                 for e in alive]
+    return {
+        'entities': len(manager.systems),
+        'bullets': len(manager.query(BulletController)),
+        'enemies_alive': len(alive),
+        'enemies_with_path': sum(
+            1 for e in alive if e.component(PathFinding).path),
+        'mean_enemy_distance': (sum(distances) / len(distances)
+                                if distances else None),
+        'player': player,
+    }
+
+
+def run_shard(conn, specs, ticks, every):
+    """
+    Worker process: step the worlds of given specs for ticks ticks,
+    sending ('metrics', index, tick, metrics) every every ticks and
+    after the last one, then ('done',), or ('error', traceback).
+    """
+    try:
+        # Answer every path request in the frame it's made, so results
+        # don't depend on how busy the machine is
+        config.PATH_FRAME_BUDGET = None
+        worlds = [(spec['index'], build_world(spec)) for spec in specs]
+        dt = 1.0/config.TICK_RATE
+        for tick in range(1, ticks+1):
+            for index, world in worlds:
+                world.update(dt)
+            if tick % every == 0 or tick == ticks:
+                for index, world in worlds:
+                    conn.send(('metrics', index, tick,
+                               world_metrics(world)))
+        conn.send(('done',))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def run_batch(specs, ticks, workers=None, every=60):
+    """
+    Run worlds of given specs in worker processes.
+    Yield (world index, tick, metrics) as they arrive.
+    """
+    workers = min(workers or multiprocessing.cpu_count(), len(specs))
+    processes = []
+    connections = []
+    for i in range(workers):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=run_shard, args=(writer, specs[i::workers], ticks, every))
+        process.daemon = True
+        process.start()
+        # Only the worker writes, so reader gets EOF if it dies
+        writer.close()
+        processes.append(process)
+        connections.append(reader)
+    try:
+        while connections:
+            for conn in wait(connections):
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    message = ('error', 'worker exited without a result')
+                if message[0] == 'metrics':
+                    yield message[1:]
+                    continue
+                connections.remove(conn)
+                conn.close()
+                if message[0] == 'error':
+                    raise BatchError(message[1])
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def parse_assignment(text):
+    """
+    Parse 'name=value' or 'name=value,value', values as JSON.
+    """
+    name, _, values = text.partition('=')
+    return name, [json.loads(value) for value in values.split(',')]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='batch')
+    parser.add_argument('--level', choices=sorted(LEVELS),
+                        default='level0')
+    parser.add_argument('--ticks', type=int, default=600)
+    parser.add_argument('--every', type=int, default=60,
+                        help='ticks between metrics of each world')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=1,
+                        help='worlds per combination of --param values')
+    parser.add_argument('--param', action='append', default=[],
+                        metavar='NAME=VALUE[,VALUE...]',
+                        help='AI Movement attribute to try values of')
+    parser.add_argument('--level-arg', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='keyword argument for the level')
+    args = parser.parse_args(argv[1:])
+
+    param_grid = dict(parse_assignment(p) for p in args.param)
+    level_kwargs = dict((name, values[0]) for name, values
+                        in map(parse_assignment, args.level_arg))
+    specs = make_specs(args.level, args.seed, param_grid, args.repeats,
+                       level_kwargs)
+    for index, tick, metrics in run_batch(specs, args.ticks, args.workers,
+                                          args.every):
+        spec = specs[index]
+        row = {'world': index, 'seed': spec['seed'],
+               'ai_params': spec['ai_params'], 'tick': tick}
+        row.update(metrics)
+        sys.stdout.write(json.dumps(row, sort_keys=True) + '\n')
+        sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
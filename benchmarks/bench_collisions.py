@@ -0,0 +1,88 @@
+"""
+Compare the brute force CollisionManager with CollisionManagerGrid.
+
+Builds a level of randomly placed boxes and times one full collision
+pass (every entity queried once), then moves a fraction of the boxes
+and times another pass, so bucket updates are included.
+
+    python -m benchmarks.bench_collisions [entity count] [passes]
+"""
+import random
+import sys
+import time
+
+from component import Spatial, Collisions
+from entity import Entity
+import collisions
+from collisions import (CollisionManager, CollisionManagerGrid,
+                        CollisionManagerNumpy)
+
+
+def build_entities(count, seed=0, width=2560*4, height=2048*4):
+    rand = random.Random(seed)
+    entities = []
+    for i in range(count):
+        e = Entity(Spatial(width=rand.choice((8, 72, 256)),
+                           height=rand.choice((8, 24, 72))),
+                   Collisions())
+        e.component(Spatial).bottomleft = (rand.randrange(0, width),
+                                           rand.randrange(0, height))
+        entities.append(e)
+    return entities
+
+
+def collision_pass(manager, entities):
+    count = 0
+    for e in entities:
+        for c in manager.objs_colliding(e):
+            count += 1
+    return count
+
+
+def move_some(entities, seed=1, fraction=0.1):
+    rand = random.Random(seed)
+    for e in rand.sample(entities, int(len(entities)*fraction)):
+        s = e.component(Spatial)
+        s.x += rand.randrange(-300, 300)
+        s.y += rand.randrange(-300, 300)
+
+
+def run(manager_factory, count, passes):
+    entities = build_entities(count)
+    manager = manager_factory()
+    manager.add(*entities)
+    found = []
+    start = time.time()
+    for i in range(passes):
+        found.append(collision_pass(manager, entities))
+        move_some(entities, seed=i)
+    return time.time() - start, found
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 3000
+    passes = int(argv[2]) if len(argv) > 2 else 3
+    managers = (
+        ('brute force', CollisionManager),
+        ('grid 256x256', lambda: CollisionManagerGrid(cell_width=256,
+                                                      cell_height=256)),
+        ('grid 128x128', lambda: CollisionManagerGrid(cell_width=128,
+                                                      cell_height=128)),
+    )
+    if collisions.numpy is not None:
+        managers += (('numpy', CollisionManagerNumpy),)
+    print('{} entities, {} passes'.format(count, passes))
+    results = {}
+    for name, factory in managers:
+        elapsed, found = run(factory, count, passes)
+        results[name] = found
+        print('{:<14} {:8.3f}s total {:8.2f}ms/pass  collisions: {}'.format(
+            name, elapsed, elapsed/passes*1000, found))
+    if len(set(tuple(f) for f in results.values())) != 1:
+        print('WARNING: managers disagree on collision counts')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
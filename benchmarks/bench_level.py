@@ -0,0 +1,169 @@
+"""
+Step a seeded StressLevel headlessly and report frames per second,
+path graph build time, per system time and peak memory.
+
+    python -m benchmarks.bench_level [options] [--json results.json]
+    python -m benchmarks.bench_level --compare old.json new.json
+
+Results saved with --json can be compared between commits with
+--compare, which prints the ratio of each timing (new/old).
+
+The path graph is built every run, unless --path-cache is given
+(see config.PATH_GRAPH_CACHE). --numpy-collisions keeps collidables
+in a CollisionManagerNumpy (see config.NUMPY_COLLISIONS).
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import config
+# Before anything imports backend
+config.HEADLESS = True
+
+from benchmarks.levels import StressLevel
+from profiler import FrameProfiler
+
+
+def peak_memory():
+    """
+    Return peak resident memory of this process in kilobytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes on macOS
+        peak //= 1024
+    return peak
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    config.PATH_GRAPH_CACHE = args.path_cache
+    config.PATH_GRAPH_WORKERS = args.graph_workers
+    config.NUMPY_COLLISIONS = args.numpy_collisions
+    params = dict(platforms=args.platforms, ai_players=args.ai,
+                  elevators=args.elevators, gunners=args.gunners,
+                  fire_interval=args.fire_interval, seed=args.seed)
+    dt = 1.0/config.TICK_RATE
+
+    start = time.time()
+    level = StressLevel(**params)
+    build_time = time.time() - start
+    manager = level.systems_manager
+
+    for i in range(args.warmup):
+        level.update(dt)
+    start = time.time()
+    for i in range(args.frames):
+        level.update(dt)
+    run_time = time.time() - start
+
+    # Separate run for the breakdown, the profiler adds some overhead
+    manager.profiler = FrameProfiler(window=args.frames)
+    for i in range(args.frames):
+        level.update(dt)
+    systems = dict((row[0], dict(zip(FrameProfiler.columns[1:], row[1:])))
+                   for row in manager.profiler.stats())
+
+    return {
+        'commit': commit(),
+        'params': params,
+        'collidables': type(manager.collidables).__name__,
+        'frames': args.frames,
+        'entities': len(manager.systems),
+        'nodes': len(manager.pathfinding.nodes),
+        'level_build_s': build_time,
+        'graph_build_s': level.graph_time,
+        'run_s': run_time,
+        'fps': args.frames / run_time,
+        'frame_ms': run_time / args.frames * 1000,
+        'peak_memory_kb': peak_memory(),
+        'systems': systems,
+    }
+
+
+def report(result, f=sys.stdout):
+    f.write('commit {}  {}\n'.format(result['commit'], result['params']))
+    f.write('{} entities, {} path nodes, {}\n'.format(
+        result['entities'], result['nodes'], result['collidables']))
+    f.write('level built in {:.3f}s, path graph in {:.3f}s\n'.format(
+        result['level_build_s'], result['graph_build_s']))
+    f.write('{} frames: {:.1f} fps, {:.3f}ms/frame\n'.format(
+        result['frames'], result['fps'], result['frame_ms']))
+    f.write('peak memory {:.1f}MB\n'.format(
+        result['peak_memory_kb'] / 1024.0))
+    f.write('{:<24}{:>9}{:>9}{:>9}{:>9}\n'.format(
+        'ms/frame', 'mean', 'p50', 'p95', 'p99'))
+    rows = sorted(result['systems'].items(),
+                  key=lambda item: item[1]['mean'], reverse=True)
+    for name, stats in rows:
+        f.write('{:<24}{mean:>9.3f}{p50:>9.3f}{p95:>9.3f}{p99:>9.3f}\n'
+                .format(name, **stats))
+
+
+def compare(old, new, f=sys.stdout):
+    """
+    Print new/old ratios of the timings in two results.
+    """
+    def line(label, a, b):
+        ratio = float(b) / a if a else float('inf')
+        f.write('{:<24}{:>10.3f}{:>10.3f}{:>8.2f}x\n'.format(
+            label, a, b, ratio))
+    f.write('{:<24}{:>10}{:>10}{:>9}\n'.format(
+        '', old['commit'], new['commit'], 'new/old'))
+    for key in ('level_build_s', 'graph_build_s', 'frame_ms'):
+        line(key, old[key], new[key])
+    line('peak_memory_kb', old['peak_memory_kb'], new['peak_memory_kb'])
+    for name in sorted(set(old['systems']) & set(new['systems'])):
+        line(name, old['systems'][name]['mean'],
+             new['systems'][name]['mean'])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='bench_level')
+    parser.add_argument('--platforms', type=int, default=200)
+    parser.add_argument('--ai', type=int, default=20)
+    parser.add_argument('--elevators', type=int, default=10)
+    parser.add_argument('--gunners', type=int, default=5)
+    parser.add_argument('--fire-interval', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--warmup', type=int, default=60)
+    parser.add_argument('--path-cache', metavar='DIR',
+                        help='load/save path graphs in this directory')
+    parser.add_argument('--graph-workers', type=int, default=0,
+                        help='processes to build the path graph in')
+    parser.add_argument('--numpy-collisions', action='store_true',
+                        help='keep collidables in numpy arrays')
+    parser.add_argument('--json', help='save results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two saved results and exit')
+    args = parser.parse_args(argv[1:])
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        compare(old, new)
+        return 0
+
+    result = run(args)
+    report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
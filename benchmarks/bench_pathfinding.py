@@ -0,0 +1,96 @@
+"""
+Benchmark PathSystem.find_path on a generated level.
+
+Generates rows of randomly placed platforms with a node every
+config.NODE_SPACING on top, builds the graph for the default
+PlayerMovement jump stats, then times random path queries with
+an empty cache and again with the cache warm.
+
+    python -m benchmarks.bench_pathfinding [node count] [queries]
+"""
+import random
+import sys
+import time
+
+import config
+from collisions import CollisionManagerGrid
+from component import PlayerMovement
+from system import SystemsManager, PathSystem
+import pathgraph
+
+
+def generate_level(node_count, seed=0, rows=12, row_height=160):
+    """
+    Return (boxes, nodes) for a level with node_count nodes
+    spread over given number of platform rows.
+    Nodes are (x, y) tuples.
+    """
+    rand = random.Random(seed)
+    boxes = []
+    nodes = []
+    per_row = node_count // rows + 1
+    for row in range(rows):
+        y = row * row_height
+        row_nodes = []
+        x = rand.randrange(0, 256)
+        while len(row_nodes) < per_row:
+            solid_edges = (('top',) if rand.random() < 0.5
+                           else ('left', 'right', 'top', 'bottom'))
+            boxes.append((x, y-24, x+256, y, solid_edges))
+            for nx in range(x, x+257, config.NODE_SPACING):
+                row_nodes.append((nx, y))
+            x += 256 + rand.randrange(64, 512)
+        nodes.extend(row_nodes)
+    return boxes, nodes[:node_count]
+
+
+def build_path_system(boxes, nodes, stats):
+    manager = SystemsManager(CollisionManagerGrid(), None)
+    paths = PathSystem(manager)
+    paths.geometry = pathgraph.StaticGeometry(boxes)
+    for node in nodes:
+        paths.nodes[node] = {}
+        paths.reverse_edges[node] = {}
+        paths.node_positions[node] = node
+        paths.node_index.add(node, node[0])
+    for node in nodes:
+        paths.set_edges(node, stats, paths.find_edges(node, stats))
+    return paths
+
+
+def main(argv):
+    node_count = int(argv[1]) if len(argv) > 1 else 10000
+    query_count = int(argv[2]) if len(argv) > 2 else 200
+    m = PlayerMovement()
+    stats = (m.max_jump_x, m.max_jump_y)
+    boxes, nodes = generate_level(node_count)
+
+    start = time.time()
+    paths = build_path_system(boxes, nodes, stats)
+    build_time = time.time() - start
+    edge_count = sum(len(e[stats]) for e in paths.nodes.values())
+    print('{} nodes, {} edges, graph built in {:.3f}s'.format(
+        len(nodes), edge_count, build_time))
+
+    rand = random.Random(1)
+    queries = [(rand.choice(nodes), rand.choice(nodes))
+               for i in range(query_count)]
+    found = 0
+    start = time.time()
+    for a, b in queries:
+        if paths.find_path(a, b, stats):
+            found += 1
+    cold = time.time() - start
+    start = time.time()
+    for a, b in queries:
+        paths.find_path(a, b, stats)
+    warm = time.time() - start
+    print('{} queries, {} paths found'.format(query_count, found))
+    print('cold: {:8.3f}ms/query'.format(cold/query_count*1000))
+    print('warm: {:8.3f}ms/query  (cache hits: {})'.format(
+        warm/query_count*1000, paths.path_cache.hits))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
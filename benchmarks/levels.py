@@ -0,0 +1,118 @@
+"""
+Seeded synthetic levels for benchmarks.
+
+Everything random comes from one random.Random(seed), so a level and
+the way it plays out are the same on every run and every commit.
+"""
+import math
+import random
+import time
+
+from component import *
+import entity
+import level
+
+
+class StressLevel(level.Level0):
+    """
+    Level0 scaled up: platforms rows of given count, AI players that
+    chase the player, continuously moving elevators and AI gunners
+    that keep firing (the bullet storm).
+    """
+    row_height = 200
+
+    def __init__(self, platforms=200, ai_players=20, elevators=10,
+                 gunners=5, fire_interval=6, seed=0, layer=None,
+                 ai_params=None):
+        self.platform_count = platforms
+        self.ai_count = ai_players
+        self.elevator_count = elevators
+        self.gunner_count = gunners
+        # Frames between shots of each gunner
+        self.fire_interval = fire_interval
+        self.frame = 0
+        rows = max(1, int(math.sqrt(platforms / 4.0)))
+        self.per_row = int(math.ceil(platforms / float(rows)))
+        self.width = (self.per_row + 1) * 320
+        self.height = (rows + 2) * self.row_height
+        super(StressLevel, self).__init__(layer, random.Random(seed),
+                                          ai_params)
+
+    def build_platforms(self):
+        rand = self.rand
+        platforms = []
+        # Solid floor
+        for x in range(0, self.width, 256):
+            platforms.append(entity.StaticPlatform(position=(x, 50)))
+        placed = 0
+        y = self.row_height
+        while placed < self.platform_count:
+            for i in range(self.per_row):
+                if placed == self.platform_count:
+                    break
+                x = i*320 + rand.randrange(0, 64)
+                p = entity.StaticPlatform(position=(x, y))
+                if rand.random() < 0.5:
+                    p.component(Collisions).solid_edges = ('top',)
+                platforms.append(p)
+                placed += 1
+            y += self.row_height
+        for i in range(self.elevator_count):
+            vertical = rand.random() < 0.5
+            elevator = entity.Elevator(
+                position=(rand.randrange(0, self.width-256),
+                          rand.randrange(self.row_height, self.height)),
+                move_by=(0, 300) if vertical else (300, 0),
+                duration=4,
+                team='humans',
+                continuous=True)
+            platforms.append(elevator.platform)
+            platforms.append(elevator.switch)
+        return platforms
+
+    def build_paths(self):
+        start = time.time()
+        super(StressLevel, self).build_paths()
+        # Seconds the path graph took to build
+        self.graph_time = time.time() - start
+
+    def build_player(self):
+        e = super(StressLevel, self).build_player()
+        e.component(Spatial).center = (self.width//2, 200)
+        return e
+
+    def build_enemies(self):
+        rand = self.rand
+        enemies = []
+        for i in range(self.ai_count + self.gunner_count):
+            e = entity.AIPlayer('cpu')
+            e.component(Spatial).center = (rand.randrange(0, self.width),
+                                           rand.randrange(100, self.height))
+            enemies.append(e)
+        self.gunners = enemies[self.ai_count:]
+        for gunner in self.gunners:
+            inventory = gunner.component(Inventory)
+            inventory.add(Pistol())
+            inventory.equip(0)
+            inventory.equipped.attacking = False
+        return enemies
+
+    def update(self, dt):
+        rand = self.rand
+        paths = self.systems_manager.pathfinding
+        if self.frame % 60 == 0:
+            # Chase the player
+            goal = paths.nearest_node(self.player)
+            if goal is not None:
+                for e in self.enemies[:self.ai_count]:
+                    # Killed ones are out of the manager
+                    if e.systems_manager is not None:
+                        e.component(PathFinding).set_goal(goal)
+        for i, gunner in enumerate(self.gunners):
+            weapon = gunner.component(Inventory).equipped
+            weapon.attacking = (self.frame + i) % self.fire_interval == 0
+            if weapon.attacking:
+                angle = rand.uniform(0, 2*math.pi)
+                weapon.facing = [math.cos(angle), math.sin(angle)]
+        self.frame += 1
+        super(StressLevel, self).update(dt)
@@ -1,14 +1,63 @@
+import heapq
+from operator import itemgetter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from component import *
 
 """
 Experimenting with collision manager using Spatial component.
 """
 
+
+def sweep(rect, dx, dy, other):
+    """
+    Return the time of impact (0 to 1) of rect moving by dx, dy
+    with other, or None if they never overlap on the way.
+    0 if they overlap at the start already.
+    Rects are anything with left, bottom, right and top,
+    touching edges don't count as overlapping.
+    """
+    inf = float('inf')
+    if dx > 0:
+        x_entry = (other.left - rect.right) / float(dx)
+        x_exit = (other.right - rect.left) / float(dx)
+    elif dx < 0:
+        x_entry = (other.right - rect.left) / float(dx)
+        x_exit = (other.left - rect.right) / float(dx)
+    elif rect.right <= other.left or rect.left >= other.right:
+        return None
+    else:
+        x_entry, x_exit = -inf, inf
+    if dy > 0:
+        y_entry = (other.bottom - rect.top) / float(dy)
+        y_exit = (other.top - rect.bottom) / float(dy)
+    elif dy < 0:
+        y_entry = (other.top - rect.bottom) / float(dy)
+        y_exit = (other.bottom - rect.top) / float(dy)
+    elif rect.top <= other.bottom or rect.bottom >= other.top:
+        return None
+    else:
+        y_entry, y_exit = -inf, inf
+    entry = max(x_entry, y_entry)
+    leave = min(x_exit, y_exit)
+    if entry >= leave or entry >= 1 or leave <= 0:
+        return None
+    return max(entry, 0.0)
+
+
 class CollisionManager(object):
+    """
+    Brute force collision manager.
+    Every query checks the entity against every known entity.
+    """
 
     def __init__(self, *entities):
-        self.add(*entities)
         self.known_entities = set()
+        self.add(*entities)
 
     def add(self, *entities):
         for e in entities:
@@ -22,6 +71,40 @@ class CollisionManager(object):
     def is_known(self, entity):
         return entity in self.known_entities
 
+    def candidates(self, rect):
+        """
+        Return entities that may overlap given rect.
+        """
+        return self.known_entities
+
+    def objs_swept(self, entity, dx, dy):
+        """
+        Return a list of (time, Collisions) of objects entity
+        overlaps on its way to where it is now, having just moved
+        by dx, dy. Time (0 to 1) is how far along the way it first
+        overlaps the object, earliest first.
+        """
+        e = entity.component(Spatial)
+        start = Rect(e.x - dx, e.y - dy, e.width, e.height)
+        area = Rect(min(start.x, e.x), min(start.y, e.y),
+                    e.width + abs(dx), e.height + abs(dy))
+        left, bottom, right, top = area.left, area.bottom, area.right, area.top
+        hits = []
+        # Copy, handlers may move entities while we iterate
+        for other in list(self.candidates(area)):
+            if other == entity:
+                continue
+            o = other.component(Spatial).rect
+            if (o.left >= right or o.right <= left
+                or o.bottom >= top or o.top <= bottom):
+                # Not even near the way
+                continue
+            t = sweep(start, dx, dy, o)
+            if t is not None:
+                hits.append((t, other.component(Collisions)))
+        hits.sort(key=itemgetter(0))
+        return hits
+
     def objs_colliding(self, entity):
         e = entity.component(Spatial)
         for other in self.known_entities:
@@ -39,3 +122,481 @@ class CollisionManager(object):
 
     def clear(self):
         self.known_entities.clear()
+
+
+class CollisionManagerGrid(CollisionManager):
+    """
+    Collision manager backed by a uniform grid (spatial hash).
+
+    Every known entity is put in the bucket of each cell its
+    Spatial rect touches, so a query only checks entities sharing
+    a cell with the queried entity.
+    Buckets are updated lazily: a Spatial notifies the manager
+    when it moves and the entity is re-bucketed on the next query.
+
+    cell_width and cell_height keyword arguments should be around
+    the size of the most common entities (e.g. platforms).
+    """
+
+    def __init__(self, *entities, **kwargs):
+        self.cell_width = kwargs.pop('cell_width', 256)
+        self.cell_height = kwargs.pop('cell_height', 256)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments {}'.format(
+                ', '.join(sorted(kwargs))))
+        # (column, row): set([entities])
+        self.cells = {}
+        # entity: (left column, bottom row, right column, top row)
+        self.entity_cells = {}
+        # Entities that moved since they were last bucketed
+        self.dirty = set()
+        super(CollisionManagerGrid, self).__init__(*entities)
+
+    def _cell_range(self, spatial):
+        cw, ch = self.cell_width, self.cell_height
+        return (int(spatial.left // cw), int(spatial.bottom // ch),
+                int(spatial.right // cw), int(spatial.top // ch))
+
+    def _insert(self, entity, cell_range):
+        cells = self.cells
+        c0, r0, c1, r1 = cell_range
+        for col in xrange(c0, c1+1):
+            for row in xrange(r0, r1+1):
+                try:
+                    cells[col, row].add(entity)
+                except KeyError:
+                    cells[col, row] = set([entity])
+        self.entity_cells[entity] = cell_range
+
+    def _discard(self, entity):
+        cells = self.cells
+        c0, r0, c1, r1 = self.entity_cells.pop(entity)
+        for col in xrange(c0, c1+1):
+            for row in xrange(r0, r1+1):
+                bucket = cells[col, row]
+                bucket.discard(entity)
+                if not bucket:
+                    del cells[col, row]
+
+    def _spatial_moved(self, spatial):
+        """
+        Watcher added to every known Spatial.
+        """
+        self.dirty.add(spatial.entity)
+
+    def _rebucket(self):
+        entity_cells = self.entity_cells
+        while self.dirty:
+            entity = self.dirty.pop()
+            if entity not in entity_cells:
+                continue
+            cell_range = self._cell_range(entity.component(Spatial))
+            if cell_range == entity_cells[entity]:
+                continue
+            self._discard(entity)
+            self._insert(entity, cell_range)
+
+    def add(self, *entities):
+        for e in entities:
+            if isinstance(e, Component):
+                e = e.entity
+            if e in self.known_entities:
+                continue
+            self.known_entities.add(e)
+            spatial = e.component(Spatial)
+            spatial.watchers.append(self._spatial_moved)
+            self._insert(e, self._cell_range(spatial))
+
+    def remove(self, entity):
+        self.known_entities.remove(entity)
+        entity.component(Spatial).watchers.remove(self._spatial_moved)
+        self._discard(entity)
+        self.dirty.discard(entity)
+
+    def candidates(self, spatial):
+        """
+        Return a set of entities sharing a cell with given spatial
+        (or rect).
+        """
+        self._rebucket()
+        cells = self.cells
+        c0, r0, c1, r1 = self._cell_range(spatial)
+        if c0 == c1 and r0 == r1:
+            return cells.get((c0, r0), ())
+        found = set()
+        for col in xrange(c0, c1+1):
+            for row in xrange(r0, r1+1):
+                try:
+                    found.update(cells[col, row])
+                except KeyError:
+                    pass
+        return found
+
+    def objs_colliding(self, entity):
+        e = entity.component(Spatial)
+        # Copy, handlers may move entities while we iterate
+        for other in list(self.candidates(e)):
+            if other == entity:
+                continue
+            o = other.component(Spatial)
+            if e.left >= o.right or e.right <= o.left:
+                continue
+            if e.bottom >= o.top or e.top <= o.bottom:
+                continue
+            yield other.component(Collisions)
+
+    def clear(self):
+        for e in self.known_entities:
+            e.component(Spatial).watchers.remove(self._spatial_moved)
+        self.known_entities.clear()
+        self.cells.clear()
+        self.entity_cells.clear()
+        self.dirty.clear()
+
+
+class CollisionManagerNumpy(CollisionManager):
+    """
+    Collision manager keeping the rects of all known entities in
+    numpy arrays, so a query is a few vectorized comparisons
+    instead of a Python loop over candidates.
+
+    Row i of each array belongs to entities[i]. Rows are updated by
+    a watcher on every known Spatial, like the movement engine does.
+    Solid edges of each entity's Collisions are kept as boolean
+    columns (see PathSystem.find_edges), updated by a watcher on
+    the Collisions.
+
+    Optional, requires numpy.
+    """
+    # Rows compared at once in pairs()
+    chunk_size = 256
+
+    def __init__(self, *entities):
+        if numpy is None:
+            raise ImportError('CollisionManagerNumpy requires numpy')
+        self.count = 0
+        self.entities = []
+        # entity: row
+        self.rows = {}
+        # entity: its watched Collisions, which may be taken off
+        # entity before it's removed here
+        self.collisions = {}
+        self._allocate(64)
+        super(CollisionManagerNumpy, self).__init__(*entities)
+
+    def _allocate(self, capacity):
+        count = self.count
+        for name, dtype in (('left', float), ('bottom', float),
+                            ('right', float), ('top', float),
+                            ('solid_left', bool), ('solid_right', bool),
+                            ('solid_bottom', bool), ('solid_top', bool)):
+            array = numpy.zeros(capacity, dtype)
+            if count:
+                array[:count] = getattr(self, name)[:count]
+            setattr(self, name, array)
+
+    def _set_row(self, row, rect):
+        self.left[row] = rect.left
+        self.bottom[row] = rect.bottom
+        self.right[row] = rect.right
+        self.top[row] = rect.top
+
+    def _set_solid(self, row, solid_edges):
+        self.solid_left[row] = 'left' in solid_edges
+        self.solid_right[row] = 'right' in solid_edges
+        self.solid_bottom[row] = 'bottom' in solid_edges
+        self.solid_top[row] = 'top' in solid_edges
+
+    def _spatial_moved(self, spatial):
+        """
+        Watcher added to every known Spatial.
+        """
+        self._set_row(self.rows[spatial.entity], spatial.rect)
+
+    def _solid_edges_changed(self, collisions):
+        """
+        Watcher added to every known Collisions.
+        """
+        self._set_solid(self.rows[collisions.entity],
+                        collisions.solid_edges)
+
+    def add(self, *entities):
+        for e in entities:
+            if isinstance(e, Component):
+                e = e.entity
+            if e in self.known_entities:
+                continue
+            if self.count == len(self.left):
+                self._allocate(2*self.count)
+            row = self.count
+            spatial = e.component(Spatial)
+            collisions = e.component(Collisions)
+            self._set_row(row, spatial.rect)
+            self._set_solid(row, collisions.solid_edges)
+            self.known_entities.add(e)
+            self.entities.append(e)
+            self.rows[e] = row
+            self.collisions[e] = collisions
+            spatial.watchers.append(self._spatial_moved)
+            collisions.watchers.append(self._solid_edges_changed)
+            self.count += 1
+
+    def remove(self, entity):
+        self.known_entities.remove(entity)
+        entity.component(Spatial).watchers.remove(self._spatial_moved)
+        self.collisions.pop(entity).watchers.remove(
+            self._solid_edges_changed)
+        row = self.rows.pop(entity)
+        last = self.count - 1
+        if row != last:
+            # Move last row into the gap
+            for array in (self.left, self.bottom, self.right, self.top,
+                          self.solid_left, self.solid_right,
+                          self.solid_bottom, self.solid_top):
+                array[row] = array[last]
+            moved = self.entities[last]
+            self.entities[row] = moved
+            self.rows[moved] = row
+        self.entities.pop()
+        self.count -= 1
+
+    def overlapping(self, left, bottom, right, top):
+        """
+        Return an array of rows overlapping given rect.
+        Touching edges don't count.
+        """
+        count = self.count
+        mask = self.left[:count] < right
+        mask &= self.right[:count] > left
+        mask &= self.bottom[:count] < top
+        mask &= self.top[:count] > bottom
+        return numpy.flatnonzero(mask)
+
+    def pairs(self, interested):
+        """
+        Return a set of the overlapping (entity, entity) pairs
+        with at least one entity in interested, ordered by id.
+        Touching edges don't count.
+        """
+        rows = self.rows
+        chosen = numpy.array([rows[e] for e in interested if e in rows],
+                             int)
+        count = self.count
+        left, bottom = self.left[:count], self.bottom[:count]
+        right, top = self.right[:count], self.top[:count]
+        entities = self.entities
+        pairs = set()
+        for start in range(0, len(chosen), self.chunk_size):
+            # Chosen rows of the chunk against all rows
+            chunk = chosen[start:start + self.chunk_size]
+            mask = left[chunk, None] < right
+            mask &= right[chunk, None] > left
+            mask &= bottom[chunk, None] < top
+            mask &= top[chunk, None] > bottom
+            mask[numpy.arange(len(chunk)), chunk] = False
+            found, others = numpy.nonzero(mask)
+            for a, b in zip(chunk[found].tolist(), others.tolist()):
+                a, b = entities[a], entities[b]
+                if id(a) < id(b):
+                    pairs.add((a, b))
+                else:
+                    pairs.add((b, a))
+        return pairs
+
+    def candidates(self, rect):
+        """
+        Return entities overlapping given rect.
+        """
+        entities = self.entities
+        return [entities[row] for row in self.overlapping(
+            rect.left, rect.bottom, rect.right, rect.top)]
+
+    def objs_colliding(self, entity):
+        e = entity.component(Spatial).rect
+        entities = self.entities
+        # Rows to entities first, handlers may move entities
+        # (and so rows) while we iterate
+        for other in [entities[row] for row in self.overlapping(
+                e.left, e.bottom, e.right, e.top)]:
+            if other != entity:
+                yield other.component(Collisions)
+
+    def clear(self):
+        for e in self.known_entities:
+            e.component(Spatial).watchers.remove(self._spatial_moved)
+            self.collisions[e].watchers.remove(self._solid_edges_changed)
+        self.known_entities.clear()
+        del self.entities[:]
+        self.rows.clear()
+        self.collisions.clear()
+        self.count = 0
+
+
+class StaticCollisionManagerGrid(CollisionManagerGrid):
+    """
+    Grid of entities that don't move (e.g. platforms).
+    Entities are bucketed once when added and their Spatials aren't
+    watched, remove and add an entity again if it has to move.
+    """
+
+    def add(self, *entities):
+        for e in entities:
+            if isinstance(e, Component):
+                e = e.entity
+            if e in self.known_entities:
+                continue
+            self.known_entities.add(e)
+            self._insert(e, self._cell_range(e.component(Spatial)))
+
+    def remove(self, entity):
+        self.known_entities.remove(entity)
+        self._discard(entity)
+
+    def clear(self):
+        self.known_entities.clear()
+        self.cells.clear()
+        self.entity_cells.clear()
+
+
+class PairCache(object):
+    """
+    Overlapping pairs of collidable entities, found in one sort and
+    sweep pass on x per step instead of one query per entity.
+
+    Only pairs with at least one 'interested' entity (one that
+    handles contacts) are kept. Pairs are kept between passes, so
+    each pass tells which contacts began, stayed and ended.
+    A pair is an (entity, entity) tuple, ordered by id.
+
+    Static entities (ones that never move and aren't interested)
+    are kept in a grid instead and only looked up around interested
+    entities, they are usually most of the level.
+
+    Given a CollisionManagerNumpy holding the same entities as store,
+    pairs are found with its pairs() instead, interested rects against
+    all rects at once.
+    """
+
+    def __init__(self, cell_width=256, cell_height=256, store=None):
+        # (entity, rect) in the order of the last pass,
+        # sorting a nearly sorted list is close to linear
+        self.entries = []
+        # Entities in entries
+        self.known = set()
+        self.static = StaticCollisionManagerGrid(
+            cell_width=cell_width, cell_height=cell_height)
+        self.pairs = set()
+        self.store = store
+
+    def add(self, entity, static=False):
+        """
+        Start checking entity, does nothing if it's already checked.
+        """
+        if self.is_known(entity):
+            return
+        if static:
+            self.static.add(entity)
+        else:
+            self.known.add(entity)
+            self.entries.append((entity, entity.component(Spatial).rect))
+
+    def is_known(self, entity):
+        return entity in self.known or self.static.is_known(entity)
+
+    def remove(self, entity):
+        """
+        Stop checking entity. Its pairs end on the next pass.
+        """
+        if self.static.is_known(entity):
+            self.static.remove(entity)
+            return
+        if entity not in self.known:
+            raise ValueError('{} is not known'.format(entity))
+        self.known.remove(entity)
+        for i, entry in enumerate(self.entries):
+            if entry[0] is entity:
+                del self.entries[i]
+                return
+
+    def update(self, interested, extra=()):
+        """
+        Find the overlapping pairs.
+        interested is a container of entities whose pairs are wanted,
+        extra are pairs to count as overlapping this pass anyway
+        (e.g. objects a swept entity passed through).
+        Return (began, stayed, ended) sets of pairs.
+        """
+        if self.store is not None:
+            pairs = self.store.pairs(interested)
+            pairs.update(extra)
+            return self._changes(pairs)
+        boxes = []
+        append = boxes.append
+        remaining = 0
+        for entity, rect in self.entries:
+            x, y = rect.x, rect.y
+            is_interested = entity in interested
+            remaining += is_interested
+            append((x, x + rect.width, y, y + rect.height,
+                    entity, rect, is_interested))
+        boxes.sort(key=itemgetter(0))
+        self.entries = [(box[4], box[5]) for box in boxes]
+
+        pairs = set(extra)
+        # Boxes passed whose right edge isn't behind the current
+        # left edge yet, as (right, sequence, box) heaps:
+        # all of them and only interested ones
+        active = []
+        active_interested = []
+        heappush, heappop = heapq.heappush, heapq.heappop
+        for i, box in enumerate(boxes):
+            left, right, bottom, top, entity, _, is_interested = box
+            while active_interested and active_interested[0][0] <= left:
+                heappop(active_interested)
+            if is_interested:
+                remaining -= 1
+                while active and active[0][0] <= left:
+                    heappop(active)
+                candidates = active
+            elif not active_interested:
+                if not remaining:
+                    # Nothing left can make a pair
+                    break
+                heappush(active, (right, i, box))
+                continue
+            else:
+                candidates = active_interested
+            # Pairs need one interested entity, the other may be any
+            for _, _, other in candidates:
+                if other[2] >= top or other[3] <= bottom:
+                    continue
+                other = other[4]
+                if id(entity) < id(other):
+                    pairs.add((entity, other))
+                else:
+                    pairs.add((other, entity))
+            heappush(active, (right, i, box))
+            if is_interested:
+                heappush(active_interested, (right, i, box))
+
+        if self.static.known_entities:
+            for entity in interested:
+                for ob in self.static.objs_colliding(entity):
+                    other = ob.entity
+                    if id(entity) < id(other):
+                        pairs.add((entity, other))
+                    else:
+                        pairs.add((other, entity))
+
+        return self._changes(pairs)
+
+    def _changes(self, pairs):
+        previous = self.pairs
+        self.pairs = pairs
+        return pairs - previous, pairs & previous, previous - pairs
+
+    def clear(self):
+        del self.entries[:]
+        self.known.clear()
+        self.static.clear()
+        self.pairs.clear()
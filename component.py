@@ -1,21 +1,18 @@
 import logging
 import math
 
-from cocos.director import director
-from cocos.euclid import Point2
-from cocos.sprite import Sprite
-
-from pyglet.window import key as keycode
-from pyglet.window.key import KeyStateHandler
-import pyglet
-
+from backend import director, Sprite, keycode, load_image
 import config
+from tracing import Tracer
 from util import distance
 
 log = logging.getLogger('compy')
+trace = Tracer('component')
 
 
 class Component(object):
+    # Subclasses without __slots__ still get a __dict__
+    __slots__ = ('entity', 'add_as')
 
     def __init__(self):
         """
@@ -34,6 +31,13 @@ class Component(object):
         """
         pass
 
+    def on_components_changed(self):
+        """
+        Called after components are added to or removed from entity.
+        Override to refresh references to sibling components.
+        """
+        pass
+
     def update(self, dt):
         """
         Update method will be called each frame
@@ -84,6 +88,10 @@ class ElevatorController(Component):
         vx = dx/self.duration
         vy = dy/self.duration
         self.entity.component(Movement).velocity = [vx, vy]
+        manager = self.entity.systems_manager
+        if manager is not None:
+            # Idle elevators sleep in the systems manager
+            manager.wake(self.entity)
 
     def stop(self):
         m = self.entity.component(Movement)
@@ -122,6 +130,8 @@ class BulletController(ElevatorController):
         self.continuous = False
         self._velocity = velocity
         self._target_point = target_point
+        # Weapon that fired it, set by AttackSystem
+        self.weapon = None
 
     def set_velocity(self, value):
         spatial = self.entity.component(Spatial)
@@ -236,7 +246,8 @@ class KeyboardController(Controller):
         if not weapon:
             return
         if self.map['attack'].intersection(pressed):
-            log.info('Attacking')
+            if trace.enabled:
+                trace('Attacking')
             entity.component(Movement).end_walk()
             weapon.perform_attack()
             for k in self.map['attack']:
@@ -315,12 +326,26 @@ class Use(Component):
 
 
 class PathFinding(Component):
+    """
+    Lets entity follow paths found by the level's PathSystem.
+    'path' is a list of path nodes, it is replaced when
+    a requested path has been found.
+    """
     def __init__(self):
         super(self.__class__, self).__init__()
         self.goal = None
         self.current_destination = None
         self.path = []
 
+    def set_goal(self, goal):
+        """
+        Ask the PathSystem for a path to given goal node.
+        Keeps following the current path until it arrives.
+        """
+        self.goal = goal
+        self.entity.systems_manager.pathfinding.request_path(
+            self.entity, goal)
+
 
 class Display(Component):
     def __init__(self, images={}, z=1):
@@ -343,12 +368,22 @@ class Display(Component):
 
     def add_image(self, key, value):
         if isinstance(value, basestring):
-            value = pyglet.resource.image(value)
+            value = load_image(value)
         self.images[key] = value
 
 
-from cocos.rect import Rect
-from cocos.euclid import Vector2
+from backend import Rect, Vector2
+
+
+def _rect_property(name):
+    """
+    Spatial property reading from and writing to given rect attribute.
+    """
+    def set_value(self, value):
+        self._set_property(name, value)
+    return property(lambda self: getattr(self.rect, name), set_value)
+
+
 class Spatial(Component):
     """
     Gives entity a rectangular area on screen.
@@ -360,18 +395,42 @@ class Spatial(Component):
     the actual sprite).
 
     Position can be updated using any 'rect' supported properties.
-    If Entity has a Display component as well, its position is updated
-    accordingly any time Spatial position is changed.
-    Same applies to Collision components, cshape position will be updated
-    to reflect spatial changes.
+    If Entity has a Display component as well, its sprite is moved
+    to the new position. Same applies to Collision components, cshape
+    position will be updated to reflect spatial changes.
+    Once the entity is in a SystemsManager, sprite and cshape are
+    synced once per frame (see sync), not on every assignment.
+
+    'old' holds the position before the last assignment on each axis,
+    for entities with a Movement component. For all other entities
+    it is kept equal to the current position.
+
+    Any callables in the 'watchers' list are called with the spatial
+    after its position or size changes (e.g. by collision managers
+    that need to keep an index up to date).
     """
+    __slots__ = ('watchers', 'width_multi', 'height_multi',
+                 'rect', 'old', 'history',
+                 '_tracks_old', '_sprite', '_cshape', '_dirty',
+                 '_center', '_prev_center')
+
     def __init__(self, sprite=None, width=1, height=1,
                  width_multi=1.0, height_multi=1.0):
         super(Spatial, self).__init__()
+        self.watchers = []
         self.width_multi, self.height_multi = width_multi, height_multi
         self.rect = self.get_rect(sprite=sprite, width=width, height=height)
         self.old = self.get_rect(sprite=sprite, width=width, height=height)
         self.history = []
+        # Sibling state, cached by on_components_changed
+        self._tracks_old = False
+        self._sprite = None
+        self._cshape = None
+        # Waiting in systems manager for sprite/cshape sync
+        self._dirty = False
+        # Center at the last sync and the one before it,
+        # the sprite is drawn between them (see SystemsManager.update)
+        self._center = self._prev_center = self.rect.center
 
     def get_rect(self, sprite=None, width=1, height=1):
         if sprite:
@@ -386,64 +445,150 @@ class Spatial(Component):
                     int(bw*self.width_multi),
                     int(bh*self.height_multi))
 
-    def _set_property(self, name, value):
-        if not self.entity or Movement not in self.entity.components:
-            old_val = value
-        else:
-            old_val = getattr(self.rect, name)
-        setattr(self.old, name, old_val)
-        setattr(self.rect, name, value)
-        # self.history.append((self.rect.right, self.rect.bottom, name,
-        #                      self.old.right, self.old.bottom))
+    def on_components_changed(self):
+        components = self.entity.components
+        self._tracks_old = Movement in components
         try:
-            s = self.entity.component(Display).sprite
-            s.position = self.rect.center
-        except:
-            # NO Display component, carry on
-            pass
+            self._sprite = components[Display].sprite
+        except KeyError:
+            self._sprite = None
         try:
-            # Adjust collision shape accordingly
-            self.entity.component(
-                Collisions).cshape.center = Vector2(*self.rect.center)
-        except:
-            # No collisions
-            pass
-
-    def __setattr__(self, name, value):
-        posattrs = ('bottom', 'top', 'left', 'right',
-                    'center', 'midtop', 'midbottom',
-                    'midleft', 'midright', 'topleft', 'topright',
-                    'bottomleft', 'bottomright',
-                    'x', 'y')
-        if name in posattrs:
-            self._set_property(name, value)
-        elif name in ('width', 'height'):
-            setattr(self.old, name, value)
-            setattr(self.rect, name, value)
-        else:
-            object.__setattr__(self, name, value)
+            self._cshape = components[Collisions].cshape
+        except KeyError:
+            self._cshape = None
+        self.sync()
 
-    def __getattr__(self, name):
-        posattrs = ('bottom', 'top', 'left', 'right',
-                    'center', 'midtop', 'midbottom',
-                    'midleft', 'midright', 'topleft', 'topright',
-                    'bottomleft', 'bottomright',
-                    'x', 'y', 'position')
-        sattrs = ('width', 'height')
-        if name in posattrs + sattrs:
-            return getattr(self.rect, name)
-        return object.__getattr__(self, name)
+    def sync(self):
+        """
+        Move sprite and cshape to current position.
+        """
+        self._dirty = False
+        center = self.rect.center
+        self._prev_center = self._center
+        self._center = center
+        if self._sprite is not None:
+            self._sprite.position = center
+        if self._cshape is not None:
+            self._cshape.center = Vector2(*center)
+
+    def interpolate(self, alpha):
+        """
+        Draw sprite alpha (0 to 1) of the way from
+        the center before the last sync to the current one.
+        """
+        if self._sprite is not None:
+            px, py = self._prev_center
+            x, y = self._center
+            self._sprite.position = (px + (x-px)*alpha, py + (y-py)*alpha)
 
+    def restore(self, x, y, old_x, old_y, width, height):
+        """
+        Set position, old position and size at once
+        (e.g. from a snapshot).
+        """
+        rect, old = self.rect, self.old
+        moved = (rect.x != x or rect.y != y
+                 or rect.width != width or rect.height != height)
+        old.x, old.y = old_x, old_y
+        old.width, old.height = width, height
+        if moved:
+            rect.x, rect.y = x, y
+            rect.width, rect.height = width, height
+            self._moved()
+
+    def _moved(self):
+        if not self._dirty:
+            manager = self.entity and self.entity.systems_manager
+            if manager:
+                # Synced by manager at the end of the frame
+                self._dirty = True
+                manager.dirty_spatials.append(self)
+            else:
+                self.sync()
+        for watcher in self.watchers:
+            watcher(self)
 
-from cocos.collision_model import AARectShape
+    def _set_property(self, name, value):
+        rect = self.rect
+        if self._tracks_old:
+            setattr(self.old, name, getattr(rect, name))
+        else:
+            setattr(self.old, name, value)
+        setattr(rect, name, value)
+        self._moved()
+
+    def set_x(self, value):
+        rect = self.rect
+        self.old.x = rect.x if self._tracks_old else value
+        rect.x = value
+        self._moved()
+
+    x = property(lambda self: self.rect.x, set_x)
+
+    def set_y(self, value):
+        rect = self.rect
+        self.old.y = rect.y if self._tracks_old else value
+        rect.y = value
+        self._moved()
+
+    y = property(lambda self: self.rect.y, set_y)
+
+    left = _rect_property('left')
+    right = _rect_property('right')
+    bottom = _rect_property('bottom')
+    top = _rect_property('top')
+    center = _rect_property('center')
+    midtop = _rect_property('midtop')
+    midbottom = _rect_property('midbottom')
+    midleft = _rect_property('midleft')
+    midright = _rect_property('midright')
+    topleft = _rect_property('topleft')
+    topright = _rect_property('topright')
+    bottomleft = _rect_property('bottomleft')
+    bottomright = _rect_property('bottomright')
+    position = property(lambda self: self.rect.position)
+
+    def set_width(self, value):
+        self.old.width = self.rect.width = value
+        for watcher in self.watchers:
+            watcher(self)
+
+    width = property(lambda self: self.rect.width, set_width)
+
+    def set_height(self, value):
+        self.old.height = self.rect.height = value
+        for watcher in self.watchers:
+            watcher(self)
+
+    height = property(lambda self: self.rect.height, set_height)
+
+
+from backend import AARectShape
 class Collisions(Component):
+    """
+    Any callables in the 'watchers' list are called with the
+    component after solid_edges is assigned (e.g. by collision
+    managers that keep a copy of them).
+    """
     def __init__(self, solid_edges=('left', 'right', 'top', 'bottom'),
-                 no_handlers=False):
+                 no_handlers=False, swept=False):
         super(Collisions, self).__init__()
-        self.solid_edges = solid_edges
+        self.watchers = []
+        self._solid_edges = solid_edges
         self.no_handlers = no_handlers
+        # Handle everything passed through while moving,
+        # not only what entity overlaps after it has moved.
+        # For fast entities, e.g. bullets.
+        self.swept = swept
         self.cshape = None
 
+    def set_solid_edges(self, value):
+        self._solid_edges = value
+        for watcher in self.watchers:
+            watcher(self)
+
+    solid_edges = property(lambda self: self._solid_edges, set_solid_edges)
+
     def get_cshape(self):
         # Depends on a Spatial component
         sp = self.entity.component(Spatial)
@@ -495,7 +640,11 @@ class Attach(Component):
         if Movement not in self.entity.components:
             self.entity.add_components(Movement())
 
-    def update(self, dt):
+    def follow(self):
+        """
+        Move entity by as much as the target moved last.
+        Called by AttachSystem once the target has moved.
+        """
         target = self.target
         spatial = self.entity.component(Spatial)
         delta_pos = (target.x - target.old.x,
@@ -549,9 +698,9 @@ class Health(Component):
         return self.amount <= 0
 
     def take_damage(self, damage):
-        log.info('giving damage: %s', damage)
         self.amount -= damage
-        log.info('health after damage: %s', self.amount)
+        if trace.enabled:
+            trace('took %s damage, health left: %s', damage, self.amount)
 
 
     def update(self, dt):
@@ -588,7 +737,8 @@ class Weapon(Component):
         self.attacking = True
 
     def perform_attack(self):
-        log.info('Perform attack called')
+        if trace.enabled:
+            trace('Perform attack called')
         self.attacking = True
 
     def end_attack(self):
@@ -616,7 +766,7 @@ class Pistol(Weapon):
                        'z': 4}),
             (Spatial, {}),
             (Hurt, {'damage': self.damage}),
-            (Collisions, {'solid_edges': ()}),
+            (Collisions, {'solid_edges': (), 'swept': True}),
             (Movement, {}),
             (BulletController, {'velocity': self.velocity}),
             (Gravity, {}),
@@ -647,17 +797,38 @@ class Push(Component):
 class Movement(Component):
     """
     Basic movement component.
+
+    velocity and acceleration are [x, y] sequences and are always
+    updated in place, so they can be rows of a physics.MovementEngine's
+    arrays while the engine manages this component.
     """
     def __init__(self):
         super(Movement, self).__init__()
-        self.acceleration = [0, 0]
-        self.velocity = [0, 0]
+        self._acceleration = [0, 0]
+        self._velocity = [0, 0]
+        # Row index in a physics.MovementEngine, or None
+        # when this component integrates itself
+        self.body = None
+
+    def set_acceleration(self, value):
+        self._acceleration[0], self._acceleration[1] = value
+
+    acceleration = property(lambda self: self._acceleration,
+                            set_acceleration)
+
+    def set_velocity(self, value):
+        self._velocity[0], self._velocity[1] = value
+
+    velocity = property(lambda self: self._velocity, set_velocity)
 
     def stop(self, axis='x'):
         index = 0 if axis == 'x' else 1
         self.acceleration[index] = self.velocity[index] = 0
 
     def update(self, dt):
+        if self.body is not None:
+            # Integrated by the movement engine
+            return
         self.velocity[0] += self.acceleration[0]*dt
         self.velocity[1] += self.acceleration[1]*dt
 
@@ -666,6 +837,49 @@ class Movement(Component):
             self.acceleration, self.velocity)
 
 
+# (walk_acceleration, max_walk_speed, jump_acceleration,
+#  max_jump_speed, gravity): (max_jump_x, max_jump_y)
+_max_jumps = {}
+
+
+def max_jump(walk_acceleration, max_walk_speed,
+             jump_acceleration, max_jump_speed, gravity):
+    """
+    Return (max_jump_x, max_jump_y), how far and how high a player
+    gets jumping from standstill while walking, until landing back
+    at the starting height.
+
+    Jump acceleration is applied until max_jump_speed is reached,
+    walk acceleration until max_walk_speed is. Solved exactly and
+    rounded to 3 decimals, the results are PathSystem graph keys.
+    Computed once per distinct set of arguments.
+    """
+    key = (walk_acceleration, max_walk_speed,
+           jump_acceleration, max_jump_speed, gravity)
+    try:
+        return _max_jumps[key]
+    except KeyError:
+        pass
+    ax, vxcap = walk_acceleration, max_walk_speed
+    ay, vycap = jump_acceleration - gravity, max_jump_speed
+    if ay <= 0 or vycap <= 0:
+        # Can't leave the ground
+        x = y = 0.0
+    else:
+        # Accelerating up until max_jump_speed...
+        t_up = float(vycap)/ay
+        y = 0.5*ay*t_up**2 + 0.5*vycap**2/gravity
+        # ...then rising to the peak and falling back down
+        t = t_up + float(vycap)/gravity + math.sqrt(2*y/gravity)
+        if ax <= 0 or vxcap <= 0:
+            x = 0.0
+        else:
+            t_walk = min(t, float(vxcap)/ax)
+            x = 0.5*ax*t_walk**2 + ax*t_walk*(t-t_walk)
+    result = _max_jumps[key] = (round(x, 3), round(y, 3))
+    return result
+
+
 class PlayerMovement(Movement):
     """
     Movement for players, jump, walk and such functions.
@@ -740,37 +954,15 @@ class PlayerMovement(Movement):
             self.acceleration[1] = 0
 
     def calculate_max_jump(self):
-        ax = self.walk_acceleration
-        ay = self.jump_acceleration
-        vxcap = self.max_walk_speed
-        vycap = self.max_jump_speed
-        g = config.GRAVITY
-        vx = vy = 0.0
-        xpos = ypos = ypeak = 0.0
-        dt = 0.1
-        while True:
-            if vx < vxcap:
-                vx += ax*dt
-            else:
-                ax = 0
-            if vy < vycap:
-                vy += ay*dt
-            else:
-                ay = 0
-            vy -= g*dt
-            xpos += vx*dt
-            ypos += vy*dt
-            if vy > 0:
-                ypeak = ypos
-            if ypos <= 0:
-                break
-        self.max_jump_y, self.max_jump_x = ypeak, xpos
-        log.info(ypeak)
+        self.max_jump_x, self.max_jump_y = max_jump(
+            self.walk_acceleration, self.max_walk_speed,
+            self.jump_acceleration, self.max_jump_speed, config.GRAVITY)
 
     def update(self, dt):
         # Update velocity using acceleration, call each frame
         if self.velocity[1] >= self.max_jump_speed:
-            log.info('at max jump speed')
+            if trace.enabled:
+                trace('at max jump speed')
             # To prevent jumping to infinite heights
             self.acceleration[1] = 0
             self.velocity[1] = self.max_jump_speed
@@ -1,14 +1,56 @@
 METER = 128
 GRAVITY = 9.8*METER
 FPS = 60
+# Simulation steps per second, independent of the frame rate
+TICK_RATE = 60
+# Most simulation steps per frame, when the frame rate drops further
+# the game slows down instead of falling further behind
+MAX_TICKS_PER_FRAME = 5
 TEAMKILL = False
+# Removed bullets kept for reuse, per weapon (see AttackSystem)
+BULLET_POOL_SIZE = 64
+# Run without cocos/pyglet, see backend.py
+HEADLESS = False
 NODE_SPACING = 1*METER
+# How far path nodes and moving platforms move before
+# PathSystem recomputes the edges around them
+PATH_REFRESH_DISTANCE = 16
+# Number of recent paths PathSystem.find_path keeps
+PATH_CACHE_SIZE = 256
+# Seconds per frame PathSystem may spend answering path requests.
+# None for no limit, paths then don't depend on how fast the machine is
+PATH_FRAME_BUDGET = 0.002
+# Directory PathSystem caches path graphs in, keyed by level
+# geometry and player stats. None to always build them. Only worth
+# it for levels built the same way every time (e.g. seeded ones),
+# see benchmarks/bench_level.py --path-cache
+PATH_GRAPH_CACHE = None
+# Most graphs kept there, the least recently used go first
+PATH_GRAPH_CACHE_FILES = 32
+# Processes PathSystem finds edges in when it builds a graph,
+# 0 or 1 to build it in this process
+PATH_GRAPH_WORKERS = 0
+# Agents sharing a goal that get a flow field instead of A* searches
+FLOW_FIELD_MIN_AGENTS = 2
+# Use the numpy movement engine (physics.py) when numpy is available
+NUMPY_MOVEMENT = True
+# Keep level collidables in numpy arrays (collisions.py) when numpy
+# is available, instead of a grid. Contact pairs and path graphs are
+# found with vectorized comparisons (see benchmarks.bench_level)
+NUMPY_COLLISIONS = True
 
 
 import logging
 import logging.handlers
 
 LOG_LEVEL = logging.INFO
+# Per-frame messages go through tracing.py instead of logging,
+# False skips them entirely
+TRACE = True
+# Trace records kept until the flush thread logs them
+TRACE_BUFFER_SIZE = 4096
+# Seconds between flushes
+TRACE_FLUSH_INTERVAL = 0.5
 def init_log():
     log = logging.getLogger('compy')
     hdlr = logging.StreamHandler()
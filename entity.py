@@ -1,16 +1,19 @@
 import types
 from collections import OrderedDict
 
-from cocos.sprite import Sprite
-from cocos.rect import Rect
-from cocos import collision_model
-
 from component import *
 
 
 class Entity(object):
     def __init__(self, *components):
         self.components = OrderedDict()
+        # Set by SystemsManager when entity is added to it
+        self.systems_manager = None
+        # Unique in the SystemsManager, set when added to it
+        self.id = None
+        # util.Pool SystemsManager releases entity and its systems to
+        # instead of discarding them when entity is removed
+        self.pool = None
         self.add_components(*components)
 
     def add_components(self, *components):
@@ -18,15 +21,23 @@ class Entity(object):
             component.entity = self
             self.components[component.add_as] = component
             component.on_add()
+            if self.systems_manager:
+                self.systems_manager.component_added(self, component)
+        for component in self.components.values():
+            component.on_components_changed()
 
     def component(self, klass):
         return self.components[klass]
 
     def remove_component(self, component):
         if isinstance(component, (type, types.ClassType)):
-            self.components.pop(component)
+            component = self.components.pop(component)
         else:
-            self.components.pop(component.__class__)
+            self.components.pop(component.add_as)
+        for c in self.components.values():
+            c.on_components_changed()
+        if self.systems_manager:
+            self.systems_manager.component_removed(self, component)
 
     def kill(self):
         self.systems_manager.remove(self)
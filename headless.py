@@ -0,0 +1,295 @@
+"""
+Lightweight stand-ins for the cocos/pyglet objects components use,
+for running levels without a window, GL context or display
+(servers, load tests, benchmarks).
+
+Only what the simulation needs is implemented: rects and collision
+shapes behave like their cocos counterparts, sprites just keep their
+position and image, images only know their size (read from the PNG
+header, nothing is decoded) and layers and the window ignore
+everything added to them.
+"""
+import os
+import struct
+
+# Directories load_image looks for images in
+resource_path = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'resources')]
+
+
+class Rect(object):
+    """
+    Same interface and rounding as cocos.rect.Rect.
+    """
+    __slots__ = ('x', 'y', 'width', 'height')
+
+    def __init__(self, x, y, width, height):
+        # Plain attributes instead of properties, they're read
+        # and written a lot more often than anything else here.
+        self.x, self.y = x, y
+        self.width, self.height = width, height
+
+    def __nonzero__(self):
+        return bool(self.width and self.height)
+
+    def __repr__(self):
+        return 'Rect(xy=%.4g,%.4g; wh=%.4g,%.4g)' % (self.x, self.y,
+                                                     self.width, self.height)
+
+    def __eq__(self, other):
+        return (self.x == other.x and self.y == other.y and
+                self.width == other.width and self.height == other.height)
+
+    __hash__ = object.__hash__
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def copy(self):
+        return self.__class__(self.x, self.y, self.width, self.height)
+
+    def set_position(self, value):
+        self.x, self.y = value
+
+    position = property(lambda self: (self.x, self.y), set_position)
+
+    def set_size(self, value):
+        self.width, self.height = value
+
+    size = property(lambda self: (self.width, self.height), set_size)
+
+    def set_origin(self, origin):
+        self.x, self.y = origin
+
+    origin = property(lambda self: (self.x, self.y), set_origin)
+
+    def set_top(self, y):
+        self.y = y - self.height
+
+    top = property(lambda self: self.y + self.height, set_top)
+
+    def set_bottom(self, y):
+        self.y = y
+
+    bottom = property(lambda self: self.y, set_bottom)
+
+    def set_left(self, x):
+        self.x = x
+
+    left = property(lambda self: self.x, set_left)
+
+    def set_right(self, x):
+        self.x = x - self.width
+
+    right = property(lambda self: self.x + self.width, set_right)
+
+    def set_center(self, center):
+        x, y = center
+        self.position = (x - self.width//2, y - self.height//2.0)
+
+    center = property(
+        lambda self: (self.x + self.width//2, self.y + self.height//2),
+        set_center)
+
+    def set_midtop(self, midtop):
+        x, y = midtop
+        self.position = (x - self.width//2, y - self.height)
+
+    midtop = property(
+        lambda self: (self.x + self.width//2, self.y + self.height),
+        set_midtop)
+
+    def set_midbottom(self, midbottom):
+        x, y = midbottom
+        self.position = (x - self.width//2, y)
+
+    midbottom = property(
+        lambda self: (self.x + self.width//2, self.y), set_midbottom)
+
+    def set_midleft(self, midleft):
+        x, y = midleft
+        self.position = (x, y - self.height//2)
+
+    midleft = property(
+        lambda self: (self.x, self.y + self.height//2), set_midleft)
+
+    def set_midright(self, midright):
+        x, y = midright
+        self.position = (x - self.width, y - self.height//2)
+
+    midright = property(
+        lambda self: (self.x + self.width, self.y + self.height//2),
+        set_midright)
+
+    def set_topleft(self, position):
+        x, y = position
+        self.position = (x, y - self.height)
+
+    topleft = property(lambda self: (self.x, self.y + self.height),
+                       set_topleft)
+
+    def set_topright(self, position):
+        x, y = position
+        self.position = (x - self.width, y - self.height)
+
+    topright = property(
+        lambda self: (self.x + self.width, self.y + self.height),
+        set_topright)
+
+    def set_bottomright(self, position):
+        x, y = position
+        self.position = (x - self.width, y)
+
+    bottomright = property(lambda self: (self.x + self.width, self.y),
+                           set_bottomright)
+
+    def set_bottomleft(self, position):
+        self.x, self.y = position
+
+    bottomleft = property(lambda self: (self.x, self.y), set_bottomleft)
+
+
+class Vector2(tuple):
+    """
+    Immutable stand-in for cocos.euclid.Vector2.
+    """
+    def __new__(cls, x=0, y=0):
+        return tuple.__new__(cls, (x, y))
+
+    x = property(lambda self: self[0])
+    y = property(lambda self: self[1])
+
+
+class AARectShape(object):
+    """
+    Stand-in for cocos.collision_model.AARectShape.
+    """
+    def __init__(self, center, half_width, half_height):
+        self.center = center
+        self.rx = half_width
+        self.ry = half_height
+
+
+class Image(object):
+    """
+    Image that only knows its size.
+    """
+    def __init__(self, name, width, height):
+        self.name = name
+        self.width = width
+        self.height = height
+
+    def __repr__(self):
+        return 'Image({}, {}x{})'.format(self.name, self.width, self.height)
+
+
+def png_size(path):
+    """
+    Return (width, height) of a PNG file, read from its header.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(24)
+    if header[:8] != '\x89PNG\r\n\x1a\n' or header[12:16] != 'IHDR':
+        raise ValueError('{} is not a PNG image'.format(path))
+    return struct.unpack('>II', header[16:24])
+
+
+# name: Image, like pyglet.resource does, images are only looked up once
+_images = {}
+
+
+def load_image(name):
+    """
+    Stand-in for pyglet.resource.image.
+    """
+    try:
+        return _images[name]
+    except KeyError:
+        pass
+    for directory in resource_path:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            width, height = png_size(path)
+            _images[name] = Image(name, width, height)
+            return _images[name]
+    raise IOError('Resource "{}" was not found on the path.'.format(name))
+
+
+def preload_images():
+    """
+    Load every PNG in resource_path.
+    """
+    for directory in resource_path:
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.png'):
+                load_image(name)
+
+
+class Sprite(object):
+    """
+    Stand-in for cocos.sprite.Sprite.
+    Anchored at the image center, like cocos sprites by default.
+    """
+    def __init__(self, image, position=(0, 0), scale=1, z=0):
+        self.image = image
+        self.position = position
+        self.scale = scale
+        self.image_anchor_x = image.width // 2
+        self.image_anchor_y = image.height // 2
+        self.visible = True
+        self.parent = None
+
+    width = property(lambda self: int(self.image.width * self.scale))
+    height = property(lambda self: int(self.image.height * self.scale))
+
+    def kill(self):
+        if self.parent is not None:
+            self.parent.remove(self)
+
+
+class NullLayer(object):
+    """
+    Layer that draws nothing.
+    """
+    def add(self, child, z=0, name=None):
+        child.parent = self
+
+    def remove(self, child):
+        child.parent = None
+
+
+# Batches draw nothing either
+BatchNode = NullLayer
+
+
+class NullWindow(object):
+    """
+    Window that never sends events.
+    """
+    def push_handlers(self, *handlers, **kwargs):
+        pass
+
+    def remove_handlers(self, *handlers, **kwargs):
+        pass
+
+
+class Director(object):
+    def __init__(self):
+        self.window = NullWindow()
+
+
+director = Director()
+
+
+class keycode(object):
+    """
+    Key symbols used by KeyboardController, same values as
+    pyglet.window.key.
+    """
+    SPACE = 32
+    A = 97
+    E = 101
+    LEFT = 65361
+    UP = 65362
+    RIGHT = 65363
+    DOWN = 65364
@@ -1,4 +1,3 @@
-import random
 import os
 
 import cocos
@@ -7,11 +6,10 @@ from cocos import layer
 
 import pyglet
 
+import backend
 from component import *
-from entity import Entity
-import entity
-from system import SystemsManager, PathSystem
-from collisions import CollisionManager
+import level
+import tracing
 #from control import KeyboardController
 
 pyglet.resource.path = [os.path.join(os.path.realpath(''), 'resources')]
@@ -24,10 +22,6 @@ class Level0(cocos.layer.Layer):
         self.is_event_handler = True
         self.width = 2560
         self.height = 2048
-        self.collidables = CollisionManager()
-        #CollisionManagerGrid(
-            # 0, self.width, 0, self.height,
-            # int(256*1.25), int(256*1.25))
 
         self.scroller = layer.scrolling.ScrollableLayer()
         self.scroller.px_width, self.scroller.px_height = (
@@ -36,92 +30,18 @@ class Level0(cocos.layer.Layer):
         self.scroll_man.add(self.scroller)
         self.add(self.scroll_man)
 
-        self.systems_manager = SystemsManager(self.collidables, self.scroller)
-
-        self.platforms = self.build_platforms()
-        self.player = self.build_player()
-        self.enemies = self.build_enemies()
-
-        self.systems_manager.add_entities(*self.platforms)
-        self.systems_manager.add_entities(self.player)
-        self.systems_manager.add_entities(*self.enemies)
-        # Temporary
-        self.systems_manager.pathfinding = PathSystem(
-            self.systems_manager)
-        self.systems_manager.pathfinding.generate_graph()
-        self.systems_manager.pathfinding.draw_graph()
+        self.level = level.Level0(self.scroller)
+        self.systems_manager = self.level.systems_manager
+        self.player = self.level.player
         self.schedule(self.update)
 
         self.is_event_handler = True
 
-    def build_player(self):
-        e = entity.HumanPlayer('humans')
-        e.component(Spatial).center = (500,500)
-        e.component(Inventory).add(Pistol())
-        e.component(Inventory).equip(0)
-        return e
-
-    def build_platforms(self):
-        platforms = []
-        xpos = 0
-        for i in range(self.width/256):
-            platforms.append(
-                entity.StaticPlatform(position=(xpos, 250)))
-            xpos += 256
-
-        ypos = 200
-        for i in range(10):
-            xpos = random.randrange(100, 1024)
-            p = entity.StaticPlatform(position=(xpos, ypos))
-            if i % 2 == 0:
-                p.component(Collisions).solid_edges = ('top',)
-            platforms.append(p)
-            ypos += 200
-
-        # xpos, ypos = 400, 300
-        # platforms.append(
-        #     entity.StaticPlatform(position=(xpos, ypos)))
-
-        elevator = entity.Elevator(
-            position=(520, 300),
-            move_by=(0, 500),
-            duration=4,
-            attached_switch=True,
-            team='humans',
-            continuous=True)
-        platforms.append(elevator.platform)
-        platforms.append(elevator.switch)
-
-        elevator = entity.Elevator(
-            position=(800, 300),
-            move_by=(300, 0),
-            duration=4,
-            attached_switch=True,
-            team='humans')
-        platforms.append(elevator.platform)
-        platforms.append(elevator.switch)
-
-        elevator = entity.Elevator(
-            position=(1100, 300),
-            move_by=(300, 500),
-            duration=4,
-            attached_switch=True,
-            team='humans')
-        platforms.append(elevator.platform)
-        platforms.append(elevator.switch)
-
-        return platforms
-
-    def build_enemies(self):
-        e = entity.AIPlayer('cpu')
-        e.component(Spatial).center = 600, 500
-        return [e]
-
     def on_pop(self, *args, **kwargs):
         print 'shit fuck'
 
     def update(self, dt):
-        self.systems_manager.update(dt)
+        self.level.update(dt)
         sp = self.player.component(Spatial)
         self.scroll_man.set_focus(sp.x, sp.y)
 
@@ -142,11 +62,15 @@ class Sena(cocos.scene.Scene):
 
 
 
-cocos.director.director.init(width=1920, height=1080,
-                             caption='Compy',
-                             autoscale=True, resizable=True,
-                             fullscreen=False)
-cocos.director.director.show_FPS = True
+if __name__ == '__main__':
+    cocos.director.director.init(width=1920, height=1080,
+                                 caption='Compy',
+                                 autoscale=True, resizable=True,
+                                 fullscreen=False)
+    cocos.director.director.show_FPS = True
+    # Needs the GL context created by director.init
+    backend.preload_images()
+    tracing.start()
 
-scene = Sena(Level0())
-cocos.director.director.run(scene)
+    scene = Sena(Level0())
+    cocos.director.director.run(scene)
@@ -0,0 +1,138 @@
+"""
+Levels as plain worlds: entities, systems and the path graph,
+without any cocos scene around them.
+
+Pass a layer for the sprites to be drawn on, or None to run the level
+without drawing anything, e.g. headless (see backend.py):
+
+    level = Level0()
+    for i in range(10000):
+        level.update(1.0/config.FPS)
+"""
+import random
+
+import config
+from component import *
+import entity
+from system import SystemsManager, PathSystem
+import collisions
+import physics
+
+
+class Level0(object):
+    width = 2560
+    height = 2048
+
+    def __init__(self, layer=None, rand=random, ai_params=None):
+        self.rand = rand
+        if config.NUMPY_COLLISIONS and collisions.numpy is not None:
+            self.collidables = collisions.CollisionManagerNumpy()
+        else:
+            self.collidables = collisions.CollisionManagerGrid(
+                cell_width=256, cell_height=256)
+
+        movement_engine = None
+        if config.NUMPY_MOVEMENT and physics.numpy is not None:
+            movement_engine = physics.MovementEngine()
+        self.systems_manager = SystemsManager(self.collidables, layer,
+                                              movement_engine)
+
+        self.platforms = self.build_platforms()
+        self.player = self.build_player()
+        self.enemies = self.build_enemies()
+        if ai_params:
+            self.tune_enemies(ai_params)
+
+        self.systems_manager.add_entities(*self.platforms)
+        self.systems_manager.add_entities(self.player)
+        self.systems_manager.add_entities(*self.enemies)
+        self.build_paths()
+
+    def build_paths(self):
+        # Temporary
+        self.systems_manager.pathfinding = PathSystem(
+            self.systems_manager)
+        self.systems_manager.pathfinding.generate_graph()
+        self.systems_manager.pathfinding.draw_graph()
+
+    def tune_enemies(self, params):
+        """
+        Set Movement attributes (e.g. max_walk_speed) of enemies
+        that find paths. Before the path graph is built, so edges
+        are found for their jump stats.
+        """
+        for e in self.enemies:
+            if PathFinding not in e.components:
+                continue
+            movement = e.component(Movement)
+            for name, value in params.items():
+                if not hasattr(movement, name):
+                    raise ValueError('{} has no {}'.format(
+                        movement.__class__.__name__, name))
+                setattr(movement, name, value)
+
+    def build_player(self):
+        e = entity.HumanPlayer('humans')
+        e.component(Spatial).center = (500,500)
+        e.component(Inventory).add(Pistol())
+        e.component(Inventory).equip(0)
+        return e
+
+    def build_platforms(self):
+        platforms = []
+        xpos = 0
+        for i in range(self.width/256):
+            platforms.append(
+                entity.StaticPlatform(position=(xpos, 250)))
+            xpos += 256
+
+        ypos = 200
+        for i in range(10):
+            xpos = self.rand.randrange(100, 1024)
+            p = entity.StaticPlatform(position=(xpos, ypos))
+            if i % 2 == 0:
+                p.component(Collisions).solid_edges = ('top',)
+            platforms.append(p)
+            ypos += 200
+
+        # xpos, ypos = 400, 300
+        # platforms.append(
+        #     entity.StaticPlatform(position=(xpos, ypos)))
+
+        elevator = entity.Elevator(
+            position=(520, 300),
+            move_by=(0, 500),
+            duration=4,
+            attached_switch=True,
+            team='humans',
+            continuous=True)
+        platforms.append(elevator.platform)
+        platforms.append(elevator.switch)
+
+        elevator = entity.Elevator(
+            position=(800, 300),
+            move_by=(300, 0),
+            duration=4,
+            attached_switch=True,
+            team='humans')
+        platforms.append(elevator.platform)
+        platforms.append(elevator.switch)
+
+        elevator = entity.Elevator(
+            position=(1100, 300),
+            move_by=(300, 500),
+            duration=4,
+            attached_switch=True,
+            team='humans')
+        platforms.append(elevator.platform)
+        platforms.append(elevator.switch)
+
+        return platforms
+
+    def build_enemies(self):
+        e = entity.AIPlayer('cpu')
+        e.component(Spatial).center = 600, 500
+        return [e]
+
+    def update(self, dt):
+        self.systems_manager.update(dt)
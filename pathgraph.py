@@ -0,0 +1,405 @@
+"""
+Path graph construction helpers for PathSystem.
+
+Works on plain tuples instead of entities, so testing a candidate
+edge is a rectangle test against nearby geometry rather than a
+collision query with a throwaway entity.
+
+A box is a (left, bottom, right, top, solid_edges) tuple.
+A node position is an (x, y) tuple.
+"""
+from bisect import bisect_left, bisect_right
+import hashlib
+import marshal
+import os
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from util import distance, PriorityQueue
+
+# Bump when the way edges are found changes,
+# so graphs cached before are not used anymore
+CACHE_VERSION = 1
+
+
+def corridor(start, end):
+    """
+    Return the (left, bottom, right, top) rect an edge from
+    start to end must be clear through.
+    """
+    left = min(start[0], end[0])
+    bottom = min(start[1], end[1])
+    # Same truncation as a Spatial of that width and height
+    return (left, bottom,
+            left + int(abs(end[0]-start[0])),
+            bottom + int(abs(end[1]-start[1])))
+
+
+def overlaps(rect, box):
+    """
+    True if rect and box overlap.
+    Touching edges don't count, same as CollisionManager.
+    """
+    return not (rect[0] >= box[2] or rect[2] <= box[0]
+                or rect[1] >= box[3] or rect[3] <= box[1])
+
+
+def blocks(solid_edges, dx, dy):
+    """
+    True if a box with given solid edges stops
+    movement in direction dx, dy.
+    """
+    return ((dx > 0 and 'left' in solid_edges)
+            or (dx < 0 and 'right' in solid_edges)
+            or (dy > 0 and 'bottom' in solid_edges)
+            or (dy < 0 and 'top' in solid_edges))
+
+
+def blocked_by(start, end, boxes):
+    """
+    True if any of given boxes blocks the edge from start to end.
+    """
+    rect = corridor(start, end)
+    dx, dy = end[0]-start[0], end[1]-start[1]
+    for box in boxes:
+        if overlaps(rect, box) and blocks(box[4], dx, dy):
+            return True
+    return False
+
+
+class StaticGeometry(object):
+    """
+    Uniform grid over boxes that don't move.
+    """
+
+    def __init__(self, boxes=(), cell_size=256):
+        self.cell_size = cell_size
+        self.boxes = []
+        # (column, row): [boxes]
+        self.cells = {}
+        for box in boxes:
+            self.add(box)
+
+    def _cell_range(self, rect):
+        size = self.cell_size
+        return (int(rect[0] // size), int(rect[1] // size),
+                int(rect[2] // size), int(rect[3] // size))
+
+    def add(self, box):
+        self.boxes.append(box)
+        c0, r0, c1, r1 = self._cell_range(box)
+        for col in xrange(c0, c1+1):
+            for row in xrange(r0, r1+1):
+                self.cells.setdefault((col, row), []).append(box)
+
+    def query(self, rect):
+        """
+        Return a set of boxes overlapping rect.
+        """
+        found = set()
+        cells = self.cells
+        c0, r0, c1, r1 = self._cell_range(rect)
+        for col in xrange(c0, c1+1):
+            for row in xrange(r0, r1+1):
+                for box in cells.get((col, row), ()):
+                    if overlaps(rect, box):
+                        found.add(box)
+        return found
+
+    def blocked(self, start, end):
+        """
+        True if the edge from start to end is blocked.
+        """
+        return blocked_by(start, end, self.query(corridor(start, end)))
+
+
+class NodeIndex(object):
+    """
+    Nodes sorted by x position, for finding nodes within
+    jumping distance of a given x.
+    """
+
+    def __init__(self, positions=None):
+        self._xs = []
+        self._nodes = []
+        for node, position in (positions or {}).items():
+            self.add(node, position[0])
+
+    def add(self, node, x):
+        i = bisect_right(self._xs, x)
+        self._xs.insert(i, x)
+        self._nodes.insert(i, node)
+
+    def remove(self, node, x):
+        i = bisect_left(self._xs, x)
+        while self._nodes[i] != node:
+            i += 1
+        del self._xs[i]
+        del self._nodes[i]
+
+    def move(self, node, old_x, new_x):
+        self.remove(node, old_x)
+        self.add(node, new_x)
+
+    def between(self, left, right):
+        """
+        Return a list of nodes with left <= x <= right.
+        """
+        return self._nodes[bisect_left(self._xs, left):
+                           bisect_right(self._xs, right)]
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+class PathSearch(object):
+    """
+    Shortest paths from start over edges ({node: {stats: set([nodes])}}),
+    found a few nodes at a time so one search can be spread over frames.
+
+    With a goal it is an A* search that stops at the goal. Without one
+    it is a Dijkstra search of every node start reaches, over reverse
+    edges that makes came_from a flow field towards start.
+    """
+
+    def __init__(self, edges, positions, stats, start, goal=None):
+        self.edges = edges
+        self.positions = positions
+        self.stats = stats
+        self.start = start
+        self.goal = goal
+        self.frontier = PriorityQueue()
+        self.frontier.put(start, 0)
+        self.came_from = {start: None}
+        self.cost_so_far = {start: 0}
+        self.done = set()
+        self.finished = False
+
+    def run(self, deadline=None, until=None):
+        """
+        Expand nodes until the search is finished, node until is
+        settled (its path can't get shorter) or time.time() passes
+        deadline. Return False if stopped by the deadline.
+        """
+        if self.finished or until in self.done:
+            return True
+        positions = self.positions
+        edges = self.edges
+        stats = self.stats
+        goal = self.goal
+        if goal is not None:
+            goal_position = positions[goal]
+        frontier = self.frontier
+        came_from = self.came_from
+        cost_so_far = self.cost_so_far
+        done = self.done
+        while not frontier.empty():
+            if deadline is not None and time.time() >= deadline:
+                return False
+            current = frontier.get()
+            if current == goal:
+                break
+            if current in done:
+                # Already expanded with a lower cost
+                continue
+            done.add(current)
+            current_position = positions[current]
+            for next in edges[current].get(stats, ()):
+                next_position = positions[next]
+                new_cost = (cost_so_far[current]
+                            + distance(current_position, next_position))
+                if next not in cost_so_far or new_cost < cost_so_far[next]:
+                    cost_so_far[next] = new_cost
+                    priority = new_cost
+                    if goal is not None:
+                        priority += distance(next_position, goal_position)
+                    frontier.put(next, priority)
+                    came_from[next] = current
+            if current == until:
+                return True
+        self.finished = True
+        return True
+
+    def chain(self, node):
+        """
+        Return the list of nodes from node back to start,
+        empty if node wasn't reached.
+        """
+        came_from = self.came_from
+        if node not in came_from:
+            return []
+        nodes = []
+        while node is not None:
+            nodes.append(node)
+            node = came_from[node]
+        return nodes
+
+
+def edges_from(start, positions, index, stats, geometry, moving=()):
+    """
+    Return a set of nodes reachable from start by a player
+    with given (max_jump_x, max_jump_y) stats.
+
+    positions is a {node: (x, y)} dict, index a NodeIndex of
+    the same nodes, geometry a StaticGeometry and moving a list
+    of boxes that aren't in the geometry (e.g. elevators).
+    """
+    sx, sy = start_pos = positions[start]
+    max_jump_x, max_jump_y = stats
+    edges = set()
+    for node in index.between(sx-max_jump_x, sx+max_jump_x):
+        if node == start:
+            continue
+        end = positions[node]
+        if end[1]-sy > max_jump_y:
+            continue
+        if geometry.blocked(start_pos, end):
+            continue
+        if moving and blocked_by(start_pos, end, moving):
+            continue
+        edges.add(node)
+    return edges
+
+
+def edges_from_arrays(start, positions, index, stats, boxes):
+    """
+    Same as edges_from, but every candidate edge is tested at once
+    against boxes, a collisions.CollisionManagerNumpy holding all
+    solid boxes (static or moving) at their current position.
+    """
+    sx, sy = positions[start]
+    max_jump_x, max_jump_y = stats
+    ends = [node for node in index.between(sx-max_jump_x, sx+max_jump_x)
+            if node != start and positions[node][1]-sy <= max_jump_y]
+    if not ends:
+        return set()
+    ex, ey = numpy.array([positions[node] for node in ends], float).T
+    dx, dy = ex - sx, ey - sy
+    # Corridors, same as corridor()
+    left = numpy.minimum(ex, sx)
+    bottom = numpy.minimum(ey, sy)
+    right = left + numpy.trunc(numpy.abs(dx))
+    top = bottom + numpy.trunc(numpy.abs(dy))
+    # Solid boxes around all of them first
+    rows = boxes.overlapping(left.min(), bottom.min(),
+                             right.max(), top.max())
+    solid_left = boxes.solid_left[rows]
+    solid_right = boxes.solid_right[rows]
+    solid_bottom = boxes.solid_bottom[rows]
+    solid_top = boxes.solid_top[rows]
+    solid = solid_left | solid_right | solid_bottom | solid_top
+    rows = rows[solid]
+    if not len(rows):
+        return set(ends)
+    # Candidate edges by boxes, same as overlaps() and blocks()
+    col = (slice(None), None)
+    blocked = left[col] < boxes.right[rows]
+    blocked &= right[col] > boxes.left[rows]
+    blocked &= bottom[col] < boxes.top[rows]
+    blocked &= top[col] > boxes.bottom[rows]
+    blocked &= (((dx > 0)[col] & solid_left[solid])
+                | ((dx < 0)[col] & solid_right[solid])
+                | ((dy > 0)[col] & solid_bottom[solid])
+                | ((dy < 0)[col] & solid_top[solid]))
+    return set(node for node, b in zip(ends, blocked.any(axis=1))
+               if not b)
+
+
+def graph_key(boxes, positions, all_stats):
+    """
+    Return a hex digest identifying the edges of a graph: its solid
+    boxes, its node positions in order and the player stats edges
+    are found for.
+    """
+    data = repr((CACHE_VERSION, sorted(boxes), positions, sorted(all_stats)))
+    return hashlib.sha1(data).hexdigest()
+
+
+def load_edges(path):
+    """
+    Return {stats: [[end node index, ...] per node]} saved in path,
+    or None if there is no valid file there.
+    """
+    try:
+        with open(path, 'rb') as f:
+            edges = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    try:
+        # Recently used, see prune_cache
+        os.utime(path, None)
+    except OSError:
+        pass
+    return edges
+
+
+def save_edges(path, edges, keep=None):
+    """
+    Save edges (as returned by load_edges) to path.
+    Written to a temporary file first, so readers never see
+    half a file. Keeps at most keep graphs in the directory
+    (see prune_cache).
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp, 'wb') as f:
+        marshal.dump(edges, f)
+    os.rename(temp, path)
+    if keep is not None:
+        prune_cache(directory or '.', keep)
+
+
+def prune_cache(directory, keep):
+    """
+    Delete all but the keep most recently used .graph files
+    in directory.
+    """
+    graphs = []
+    for name in os.listdir(directory):
+        if not name.endswith('.graph'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            graphs.append((os.path.getmtime(path), path))
+        except OSError:
+            # Deleted by another process
+            pass
+    graphs.sort(reverse=True)
+    for _, path in graphs[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# Graph the worker process running edges_for_starts last built
+# its index and geometry for: (key, NodeIndex, StaticGeometry)
+_worker_graph = (None, None, None)
+
+
+def edges_for_starts(key, positions, boxes, moving, all_stats, starts):
+    """
+    Find edges of some start nodes, in a worker process.
+
+    Nodes are indexes into positions, a list of (x, y).
+    boxes are the static geometry, key identifies them and positions
+    so they are indexed only once per process.
+    Return a list of (start, stats, [end indexes]).
+    """
+    global _worker_graph
+    if _worker_graph[0] != key:
+        _worker_graph = (key, NodeIndex(dict(enumerate(positions))),
+                         StaticGeometry(boxes))
+    index, geometry = _worker_graph[1:]
+    found = []
+    for stats in all_stats:
+        for start in starts:
+            found.append((start, stats, list(edges_from(
+                start, positions, index, stats, geometry, moving))))
+    return found
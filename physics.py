@@ -0,0 +1,153 @@
+"""
+Struct-of-arrays movement engine.
+
+Optional, requires numpy. When a SystemsManager is given a
+MovementEngine, every MovementSystem registers its entity with the
+engine and stops moving the entity by itself. The engine keeps
+position, velocity, acceleration and gravity of all those entities in
+contiguous arrays and integrates them in one vectorized step per frame.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import config
+from component import Movement, Spatial
+
+
+class MovementEngine(object):
+    """
+    Row i of each array belongs to the MovementSystem in systems[i].
+    The Movement component of that system keeps views of its velocity
+    and acceleration rows, so controllers keep working on
+    movement.velocity and movement.acceleration as before.
+
+    Positions are kept in sync with Spatial writes through a Spatial
+    watcher. New positions are written back to the Spatial components
+    once per step, after integration:
+    entities that don't correct their own position on collision
+    (e.g. elevators, bullets) are written back first in a single pass,
+    then entities that do are moved and resolved one axis at a time,
+    same as MovementSystem.move does.
+    """
+
+    def __init__(self, capacity=64):
+        if numpy is None:
+            raise ImportError('MovementEngine requires numpy')
+        self.count = 0
+        self.systems = []
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        count = self.count
+        position = numpy.zeros((capacity, 2))
+        velocity = numpy.zeros((capacity, 2))
+        acceleration = numpy.zeros((capacity, 2))
+        gravity = numpy.zeros(capacity)
+        if count:
+            position[:count] = self.position[:count]
+            velocity[:count] = self.velocity[:count]
+            acceleration[:count] = self.acceleration[:count]
+            gravity[:count] = self.gravity[:count]
+        self.position = position
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.gravity = gravity
+        # Old rows are gone, rebind components to the new ones
+        for i, system in enumerate(self.systems):
+            self._bind(i, system)
+
+    def _bind(self, index, system):
+        movement = system.movement
+        movement.body = index
+        movement._velocity = self.velocity[index]
+        movement._acceleration = self.acceleration[index]
+
+    def _spatial_moved(self, spatial):
+        """
+        Watcher added to the Spatial of every managed entity.
+        """
+        index = spatial.entity.component(Movement).body
+        self.position[index] = spatial.x, spatial.y
+
+    def add(self, system):
+        """
+        Start managing given MovementSystem's entity.
+        """
+        if self.count == len(self.position):
+            self._allocate(2*self.count)
+        index = self.count
+        movement = system.movement
+        spatial = system.entity.component(Spatial)
+        self.position[index] = spatial.x, spatial.y
+        self.velocity[index] = movement.velocity
+        self.acceleration[index] = movement.acceleration
+        self.gravity[index] = 1.0 if system.gravity else 0.0
+        self.systems.append(system)
+        self._bind(index, system)
+        spatial.watchers.append(self._spatial_moved)
+        self.count += 1
+
+    def remove(self, system):
+        """
+        Stop managing given MovementSystem's entity.
+        The Movement component gets its own vectors back.
+        """
+        movement = system.movement
+        index = movement.body
+        last = self.count - 1
+        movement._velocity = self.velocity[index].tolist()
+        movement._acceleration = self.acceleration[index].tolist()
+        movement.body = None
+        system.entity.component(Spatial).watchers.remove(
+            self._spatial_moved)
+        if index != last:
+            # Move last row into the gap
+            for array in (self.position, self.velocity,
+                          self.acceleration, self.gravity):
+                array[index] = array[last]
+            moved = self.systems[last]
+            self.systems[index] = moved
+            self._bind(index, moved)
+        self.systems.pop()
+        self.count -= 1
+
+    def step(self, dt):
+        """
+        Integrate all managed entities by dt seconds.
+        """
+        count = self.count
+        if not count:
+            return
+        velocity = self.velocity[:count]
+        velocity += self.acceleration[:count]*dt
+        velocity[:, 1] -= self.gravity[:count]*(config.GRAVITY*dt)
+        target = (self.position[:count] + velocity*dt).tolist()
+
+        per_axis = []
+        for i, system in enumerate(self.systems):
+            if system.resolves_position:
+                per_axis.append(system)
+                continue
+            spatial = system.entity.component(Spatial)
+            x, y = spatial.x, spatial.y
+            spatial.bottomleft = target[i]
+            if system.collisions:
+                dx, dy = spatial.x - x, spatial.y - y
+                system.collision_system.handle_collisions(axis='y',
+                                                          dx=dx, dy=dy)
+                system.collision_system.handle_collisions(axis='x',
+                                                          dx=dx, dy=dy)
+
+        for system in per_axis:
+            spatial = system.entity.component(Spatial)
+            velocity = system.movement.velocity
+            y = spatial.y
+            spatial.y += velocity[1] * dt
+            system.collision_system.handle_collisions(axis='y',
+                                                      dy=spatial.y - y)
+            x = spatial.x
+            spatial.x += velocity[0] * dt
+            system.collision_system.handle_collisions(axis='x',
+                                                      dx=spatial.x - x)
@@ -0,0 +1,136 @@
+"""
+Per frame timing of SystemsManager updates.
+
+Opt-in, set a FrameProfiler as the manager's profiler:
+
+    manager.profiler = FrameProfiler()
+    ...
+    manager.profiler.dump()
+
+For every frame it records wall time, call count and entity count per
+system type and per component type, and keeps the last window frames.
+With no profiler set nothing is timed.
+"""
+import collections
+import csv
+import sys
+import time
+
+
+def percentile(values, p):
+    """
+    Return the p-th (0-100) percentile of sorted values,
+    nearest rank.
+    """
+    if not values:
+        return 0.0
+    rank = int(round(p/100.0 * (len(values)-1)))
+    return values[rank]
+
+
+def name(key):
+    """
+    Display name of a profiler key, a type or a string.
+    """
+    return getattr(key, '__name__', key)
+
+
+class FrameProfiler(object):
+    # Columns of stats() rows, times are milliseconds
+    columns = ('name', 'frames', 'calls', 'entities',
+               'mean', 'p50', 'p95', 'p99', 'max')
+
+    def __init__(self, window=300, clock=time.time):
+        self.window = window
+        self.clock = clock
+        # Recorded frames, oldest first
+        # Each is {key: [seconds, calls, entities]}
+        self.frames = collections.deque(maxlen=window)
+        self.frame = None
+        self._frame_start = 0.0
+        self._lap_start = 0.0
+
+    def begin_frame(self):
+        self.frame = {}
+        self._frame_start = self.clock()
+
+    def end_frame(self):
+        self.frame['frame'] = [self.clock() - self._frame_start, 1, 0]
+        self.frames.append(self.frame)
+        self.frame = None
+
+    def add(self, key, seconds, calls=1, entities=1):
+        """
+        Add time spent in key (a system or component type,
+        or a string) to the current frame.
+        """
+        try:
+            entry = self.frame[key]
+        except KeyError:
+            self.frame[key] = [seconds, calls, entities]
+            return
+        entry[0] += seconds
+        entry[1] += calls
+        entry[2] += entities
+
+    def mark(self):
+        """
+        Start timing the next lap.
+        """
+        self._lap_start = self.clock()
+
+    def lap(self, key, calls=1, entities=1):
+        """
+        Add the time since the last mark or lap to key.
+        """
+        now = self.clock()
+        self.add(key, now - self._lap_start, calls, entities)
+        self._lap_start = now
+
+    def clear(self):
+        self.frames.clear()
+
+    def stats(self):
+        """
+        Return a list of rows, one per key, slowest mean first.
+        Times are per frame in milliseconds over the frames the key
+        appeared in, calls and entities are per frame means.
+        """
+        per_key = {}
+        for frame in self.frames:
+            for key, entry in frame.items():
+                per_key.setdefault(key, []).append(entry)
+        rows = []
+        for key, entries in per_key.items():
+            count = len(entries)
+            times = sorted(e[0]*1000 for e in entries)
+            rows.append((name(key), count,
+                         sum(e[1] for e in entries) / float(count),
+                         sum(e[2] for e in entries) / float(count),
+                         sum(times) / count,
+                         percentile(times, 50),
+                         percentile(times, 95),
+                         percentile(times, 99),
+                         times[-1]))
+        rows.sort(key=lambda row: row[4], reverse=True)
+        return rows
+
+    def dump(self, f=None):
+        """
+        Write stats as a text table.
+        """
+        f = f or sys.stdout
+        f.write('{:<24}{:>7}{:>9}{:>9}{:>9}{:>9}{:>9}{:>9}{:>9}\n'.format(
+            *self.columns))
+        for row in self.stats():
+            f.write('{:<24}{:>7}{:>9.1f}{:>9.1f}'
+                    '{:>9.3f}{:>9.3f}{:>9.3f}{:>9.3f}{:>9.3f}\n'.format(*row))
+
+    def dump_csv(self, f):
+        """
+        Write stats as CSV with a header row.
+        """
+        writer = csv.writer(f)
+        writer.writerow(self.columns)
+        for row in self.stats():
+            writer.writerow(row)
@@ -0,0 +1,525 @@
+"""
+Binary snapshots of a SystemsManager's world.
+
+A snapshot holds the state of every entity in the manager: Spatial
+rects, Movement vectors, ElevatorController (and BulletController)
+timers, Health, Team, the equipped Inventory item, the Usables it
+touches, its PathFinding goal and path and whether the entity is
+asleep, as well as the contacts between entities and queued path
+requests. Restoring it puts a world built the same way (same level,
+same seed) back in that state. The path graph, sprites and systems
+are kept as they are, nothing is rebuilt.
+
+    with open('world.snap', 'wb') as f:
+        hold = snapshot.save(manager, f)
+    ...
+    snapshot.restore(manager, 'world.snap')
+    ...
+    hold.release()
+
+Entities are matched by id (see SystemsManager.add_entities).
+Entities added since the snapshot was taken are removed. Entities
+removed since then are added again: bullets are made again by the
+weapon that fired them, others are kept by the manager for as long as
+the Hold returned by save isn't released. Release it once the snapshot
+won't be restored anymore, or use it as a context manager. Entities
+that can't be brought back have their ids returned by restore.
+
+Format, little endian: a header (magic, version, manager's next_id
+and accumulator), then one record per entity, an id and a mask of
+the parts that follow, and an END id. After that the contacts, as
+pairs of ids, and the path requests, as (agent id, goal node) pairs,
+each list prefixed with its length. Path nodes are numbered by their
+place in PathSystem.node_order, not all of them are entities in the
+manager.
+"""
+import mmap
+import struct
+
+from component import *
+from system import AttackSystem, CollisionSystem
+
+MAGIC = 'CPSN'
+VERSION = 2
+# Entity id marking the end of the records
+END = 0xffffffff
+
+HEADER = struct.Struct('<4sHId')
+RECORD = struct.Struct('<IH')
+# x, y, old x, old y, width, height
+SPATIAL = struct.Struct('<4d2i')
+# velocity, acceleration
+MOVEMENT = struct.Struct('<4d')
+# jump counter, is jumping, direction
+PLAYER_MOVEMENT = struct.Struct('<i?b')
+# elapsed, duration, move_by
+CONTROLLER = struct.Struct('<4d')
+HEALTH = struct.Struct('<d')
+# Length of the name that follows
+TEAM = struct.Struct('<H')
+# equipped item index (-1 for none), facing, attacking
+INVENTORY = struct.Struct('<h2d?')
+# Bullet's shooter id, index of the weapon in its inventory
+SOURCE = struct.Struct('<Ih')
+# Length of a list of ids that follows
+COUNT = struct.Struct('<I')
+ID = struct.Struct('<I')
+# Goal node (END for none), length of the path nodes that follow
+PATH_FINDING = struct.Struct('<II')
+
+# Mask bits
+HAS_SPATIAL = 1
+HAS_MOVEMENT = 2
+HAS_PLAYER_MOVEMENT = 4
+HAS_ELEVATOR = 8
+HAS_BULLET = 16
+HAS_HEALTH = 32
+HAS_TEAM = 64
+HAS_INVENTORY = 128
+ASLEEP = 256
+HAS_SOURCE = 512
+HAS_USABLE = 1024
+HAS_PATH_FINDING = 2048
+
+
+def pack_ids(ids):
+    return COUNT.pack(len(ids)) + struct.pack('<%dI' % len(ids), *ids)
+
+
+def unpack_ids(data, offset):
+    """
+    Return (list of ids, offset after them).
+    """
+    count = COUNT.unpack_from(data, offset)[0]
+    offset += COUNT.size
+    ids = struct.unpack_from('<%dI' % count, data, offset)
+    return list(ids), offset + count*ID.size
+
+
+class SnapshotWriter(object):
+    """
+    Writes a snapshot to a file object one entity at a time,
+    close() ends it (it doesn't close the file).
+    """
+
+    def __init__(self, f, next_id=0, accumulator=0.0, nodes=()):
+        self.f = f
+        self.count = 0
+        # Path node: its number
+        self.node_numbers = dict((node, i) for i, node in enumerate(nodes))
+        f.write(HEADER.pack(MAGIC, VERSION, next_id, accumulator))
+
+    def write_entity(self, entity, asleep=False, usable=()):
+        """
+        usable is the set of Usable components entity touches.
+        """
+        components = entity.components
+        mask = ASLEEP if asleep else 0
+        parts = []
+        if Spatial in components:
+            mask |= HAS_SPATIAL
+            rect = components[Spatial].rect
+            old = components[Spatial].old
+            parts.append(SPATIAL.pack(rect.x, rect.y, old.x, old.y,
+                                      rect.width, rect.height))
+        if Movement in components:
+            mask |= HAS_MOVEMENT
+            m = components[Movement]
+            v, a = m.velocity, m.acceleration
+            parts.append(MOVEMENT.pack(v[0], v[1], a[0], a[1]))
+            if isinstance(m, PlayerMovement):
+                mask |= HAS_PLAYER_MOVEMENT
+                parts.append(PLAYER_MOVEMENT.pack(
+                    m._jump_counter, m.is_jumping, m.direction))
+        for controller_type, bit in ((ElevatorController, HAS_ELEVATOR),
+                                     (BulletController, HAS_BULLET)):
+            if controller_type in components:
+                mask |= bit
+                c = components[controller_type]
+                parts.append(CONTROLLER.pack(c._elapsed, c.duration,
+                                             c.move_by[0], c.move_by[1]))
+        weapon = (components[BulletController].weapon
+                  if BulletController in components else None)
+        if weapon is not None and weapon.entity.id is not None:
+            mask |= HAS_SOURCE
+            items = weapon.entity.component(Inventory).items
+            parts.append(SOURCE.pack(weapon.entity.id, items.index(weapon)))
+        if Health in components:
+            mask |= HAS_HEALTH
+            parts.append(HEALTH.pack(components[Health].amount))
+        if Team in components:
+            mask |= HAS_TEAM
+            name = components[Team].name
+            parts.append(TEAM.pack(len(name)))
+            parts.append(name)
+        if Inventory in components:
+            mask |= HAS_INVENTORY
+            inventory = components[Inventory]
+            equipped = inventory.equipped
+            if equipped is None:
+                parts.append(INVENTORY.pack(-1, 0, 0, False))
+            else:
+                parts.append(INVENTORY.pack(
+                    inventory.items.index(equipped),
+                    equipped.facing[0], equipped.facing[1],
+                    equipped.attacking))
+        if usable:
+            mask |= HAS_USABLE
+            parts.append(pack_ids([u.entity.id for u in usable]))
+        if PathFinding in components:
+            mask |= HAS_PATH_FINDING
+            pf = components[PathFinding]
+            numbers = self.node_numbers
+            goal = numbers[pf.goal] if pf.goal is not None else END
+            parts.append(PATH_FINDING.pack(goal, len(pf.path)))
+            parts.append(struct.pack('<%dI' % len(pf.path),
+                                     *[numbers[node] for node in pf.path]))
+        self.f.write(RECORD.pack(entity.id, mask))
+        self.f.write(''.join(parts))
+        self.count += 1
+
+    def close(self, contacts=(), requests=()):
+        """
+        End the snapshot with contacts, (entity, entity) pairs,
+        and path requests, (agent, goal node) pairs.
+        """
+        self.f.write(RECORD.pack(END, 0))
+        self.f.write(pack_ids([e.id for pair in contacts for e in pair]))
+        self.f.write(pack_ids(
+            [i for agent, goal in requests
+             for i in (agent.id, self.node_numbers[goal])]))
+
+
+class SnapshotReader(object):
+    """
+    Reads a snapshot from a file path or an open file, memory
+    mapped, or from a buffer (e.g. a bytearray).
+    Iterating gives (entity id, mask, offset) of each record,
+    read its parts with read_entity and read_links.
+    """
+
+    def __init__(self, source):
+        self._map = None
+        self._file = None
+        if isinstance(source, basestring):
+            source = self._file = open(source, 'rb')
+        if hasattr(source, 'fileno'):
+            source = self._map = mmap.mmap(source.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+        self.data = source
+        # Offset after the records, known once iterated
+        self.end = None
+        magic, version, self.next_id, self.accumulator = \
+            HEADER.unpack_from(source, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a snapshot')
+        if version != VERSION:
+            raise ValueError('Unsupported snapshot version {}'.format(
+                version))
+
+    def __iter__(self):
+        data = self.data
+        offset = HEADER.size
+        while True:
+            entity_id, mask = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if entity_id == END:
+                self.end = offset
+                return
+            yield entity_id, mask, offset
+            offset = self.skip(mask, offset)
+
+    def tail(self):
+        """
+        Return (contacts, requests) as lists of (id, id) and
+        (agent id, goal node) pairs.
+        """
+        if self.end is None:
+            for record in self:
+                pass
+        data = self.data
+        offset = self.end
+        contacts, offset = unpack_ids(data, offset)
+        requests, offset = unpack_ids(data, offset)
+        return zip(contacts[::2], contacts[1::2]), \
+            zip(requests[::2], requests[1::2])
+
+    def skip(self, mask, offset):
+        """
+        Return the offset of the record after the one at offset.
+        """
+        offset = self.skip_state(mask, offset)
+        if mask & HAS_USABLE:
+            offset = unpack_ids(self.data, offset)[1]
+        if mask & HAS_PATH_FINDING:
+            length = PATH_FINDING.unpack_from(self.data, offset)[1]
+            offset += PATH_FINDING.size + length*ID.size
+        return offset
+
+    def skip_state(self, mask, offset):
+        """
+        Return the offset of the links to other entities (see
+        read_links) of the record at offset.
+        """
+        if mask & HAS_SPATIAL:
+            offset += SPATIAL.size
+        if mask & HAS_MOVEMENT:
+            offset += MOVEMENT.size
+        if mask & HAS_PLAYER_MOVEMENT:
+            offset += PLAYER_MOVEMENT.size
+        if mask & HAS_ELEVATOR:
+            offset += CONTROLLER.size
+        if mask & HAS_BULLET:
+            offset += CONTROLLER.size
+        if mask & HAS_SOURCE:
+            offset += SOURCE.size
+        if mask & HAS_HEALTH:
+            offset += HEALTH.size
+        if mask & HAS_TEAM:
+            offset += TEAM.size + TEAM.unpack_from(self.data, offset)[0]
+        if mask & HAS_INVENTORY:
+            offset += INVENTORY.size
+        return offset
+
+    def source(self, mask, offset):
+        """
+        Return (shooter id, weapon index) of the bullet record
+        at offset, None if it has none.
+        """
+        if not mask & HAS_SOURCE:
+            return None
+        offset += SPATIAL.size + MOVEMENT.size + CONTROLLER.size
+        return SOURCE.unpack_from(self.data, offset)
+
+    def read_entity(self, entity, mask, offset):
+        """
+        Set entity's components to the record at offset.
+        """
+        data = self.data
+        components = entity.components
+        if mask & HAS_SPATIAL:
+            components[Spatial].restore(*SPATIAL.unpack_from(data, offset))
+            offset += SPATIAL.size
+        if mask & HAS_MOVEMENT:
+            vx, vy, ax, ay = MOVEMENT.unpack_from(data, offset)
+            offset += MOVEMENT.size
+            m = components[Movement]
+            m.velocity = vx, vy
+            m.acceleration = ax, ay
+            if mask & HAS_PLAYER_MOVEMENT:
+                (m._jump_counter, m.is_jumping,
+                 m.direction) = PLAYER_MOVEMENT.unpack_from(data, offset)
+                offset += PLAYER_MOVEMENT.size
+        for controller_type, bit in ((ElevatorController, HAS_ELEVATOR),
+                                     (BulletController, HAS_BULLET)):
+            if mask & bit:
+                c = components[controller_type]
+                (c._elapsed, c.duration, dx,
+                 dy) = CONTROLLER.unpack_from(data, offset)
+                c.move_by = dx, dy
+                offset += CONTROLLER.size
+        if mask & HAS_SOURCE:
+            offset += SOURCE.size
+        if mask & HAS_HEALTH:
+            components[Health].amount = HEALTH.unpack_from(data, offset)[0]
+            offset += HEALTH.size
+        if mask & HAS_TEAM:
+            length = TEAM.unpack_from(data, offset)[0]
+            offset += TEAM.size
+            components[Team].name = str(data[offset:offset+length])
+            offset += length
+        if mask & HAS_INVENTORY:
+            index, fx, fy, attacking = INVENTORY.unpack_from(data, offset)
+            inventory = components[Inventory]
+            if index < 0:
+                inventory.equipped = None
+            else:
+                inventory.equip(index)
+                inventory.equipped.facing = [fx, fy]
+                inventory.equipped.attacking = attacking
+
+    def read_links(self, entity, mask, offset, entities, systems,
+                   nodes=()):
+        """
+        Set the Usables and PathFinding of entity to the record
+        at offset. entities maps ids to entities, ones not in
+        it are left out. systems are entity's systems, nodes
+        the path nodes in PathSystem.node_order.
+        """
+        collision_system = systems.get(CollisionSystem)
+        if collision_system is not None and collision_system.usable:
+            collision_system.usable.clear()
+        if not mask & (HAS_USABLE | HAS_PATH_FINDING):
+            return
+        data = self.data
+        offset = self.skip_state(mask, offset)
+        if mask & HAS_USABLE:
+            ids, offset = unpack_ids(data, offset)
+            if collision_system is not None:
+                collision_system.usable.update(
+                    entities[i].component(Usable) for i in ids
+                    if i in entities)
+        if mask & HAS_PATH_FINDING:
+            goal, length = PATH_FINDING.unpack_from(data, offset)
+            offset += PATH_FINDING.size
+            path = struct.unpack_from('<%dI' % length, data, offset)
+            pf = entity.component(PathFinding)
+            pf.goal = nodes[goal] if goal < len(nodes) else None
+            pf.path = [nodes[i] for i in path if i < len(nodes)]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Hold(object):
+    """
+    Keeps entities removed from manager after a snapshot was saved,
+    so restore can add them again, until released. Releases itself
+    when used as a context manager.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.number = manager.hold_removed()
+
+    def release(self):
+        if self.manager is not None:
+            self.manager.release_removed(self.number)
+            self.manager = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def save(manager, f):
+    """
+    Write a snapshot of every entity in manager to file object f.
+    Return a Hold keeping entities removed from now on for restore.
+    """
+    hold = Hold(manager)
+    try:
+        paths = manager.pathfinding
+        writer = SnapshotWriter(f, manager.next_id, manager.accumulator,
+                                paths.node_order if paths else ())
+        sleeping = manager.sleeping
+        for entity, systems in manager.systems.iteritems():
+            collision_system = systems.get(CollisionSystem)
+            writer.write_entity(
+                entity, entity in sleeping,
+                collision_system.usable if collision_system else ())
+        requests = paths.requests.items() if paths else ()
+        writer.close(manager.pair_cache.pairs, requests)
+    except:
+        hold.release()
+        raise
+    return hold
+
+
+def restore(manager, source):
+    """
+    Put manager's entities in the state of the snapshot in source
+    (see SnapshotReader).
+    Return a list of ids of entities in the snapshot that couldn't
+    be brought back.
+    """
+    with SnapshotReader(source) as reader:
+        by_id = dict((entity.id, entity) for entity in manager.systems)
+        records = list(reader)
+        # Added after the snapshot, first so that bullets go back
+        # to their pools
+        kept = set(entity_id for entity_id, _, _ in records)
+        for entity_id, entity in by_id.items():
+            if entity_id not in kept:
+                manager.remove(entity)
+                del by_id[entity_id]
+        manager.process_removals()
+
+        missing = []
+        readd = []
+        bullets = []
+        for entity_id, mask, offset in records:
+            entity = by_id.get(entity_id)
+            if entity is not None:
+                reader.read_entity(entity, mask, offset)
+            elif entity_id in manager.removed:
+                entity, systems, _ = manager.removed.pop(entity_id)
+                reader.read_entity(entity, mask, offset)
+                readd.append((entity, systems))
+                by_id[entity_id] = entity
+            elif reader.source(mask, offset) is not None:
+                bullets.append((entity_id, mask, offset))
+            else:
+                missing.append(entity_id)
+        added = []
+        for entity, systems in readd:
+            manager.add_entities(entity, systems=systems, keep_ids=True)
+            added.append(entity)
+        # Made again by the weapons that fired them
+        for entity_id, mask, offset in bullets:
+            shooter_id, index = reader.source(mask, offset)
+            shooter = by_id.get(shooter_id)
+            if shooter is None:
+                missing.append(entity_id)
+                continue
+            weapon = shooter.component(Inventory).items[index]
+            attack = manager.get_system(shooter, AttackSystem)
+            entity, systems = attack.new_bullet(weapon)
+            entity.id = entity_id
+            manager.add_entities(entity, systems=systems, keep_ids=True)
+            reader.read_entity(entity, mask, offset)
+            by_id[entity_id] = entity
+            added.append(entity)
+        if added:
+            manager.sort_by_id(added)
+
+        paths = manager.pathfinding
+        nodes = paths.node_order if paths else ()
+        for entity_id, mask, offset in records:
+            entity = by_id.get(entity_id)
+            if entity is None:
+                continue
+            reader.read_links(entity, mask, offset, by_id,
+                              manager.systems[entity], nodes)
+            if mask & ASLEEP:
+                if entity not in manager.sleeping:
+                    manager.sleep(entity)
+            elif entity in manager.sleeping:
+                manager.wake(entity)
+
+        contacts, requests = reader.tail()
+        manager.pair_cache.pairs = set(
+            (by_id[a], by_id[b]) if id(by_id[a]) < id(by_id[b])
+            else (by_id[b], by_id[a])
+            for a, b in contacts if a in by_id and b in by_id)
+        if paths is not None:
+            paths.requests.clear()
+            paths.searches.clear()
+            for agent, goal in requests:
+                if agent in by_id and goal < len(nodes):
+                    paths.requests[by_id[agent]] = nodes[goal]
+
+        manager.next_id = reader.next_id
+        manager.accumulator = reader.accumulator
+        # Removed entities added after the snapshot, their ids
+        # are given out again
+        stale = [removed_id for removed_id in manager.removed
+                 if removed_id >= reader.next_id]
+        for entity_id in stale:
+            entity = manager.removed.pop(entity_id)[0]
+            if Display in entity.components:
+                entity.component(Display).sprite.kill()
+    return missing
@@ -1,14 +1,23 @@
 import logging
-from collections import OrderedDict
-
-from cocos import draw
-import cocos
-
+import os
+import time
+from collections import OrderedDict, defaultdict
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+import backend
+from archetype import ArchetypeIndex
+from collisions import PairCache, CollisionManagerNumpy
 from component import *
 from entity import Entity, PathNode
-from util import rgba
+import pathgraph
+from tracing import Tracer
+from util import rgba, distance, LRUCache, Pool, sort_ordered
 
 log = logging.getLogger('compy')
+trace = Tracer('system')
 
 
 class System(object):
@@ -45,12 +54,23 @@ class MovementSystem(System):
                 self.entity, CollisionSystem)
             self.collision_system.is_child = True
             #self.collision_system = CollisionSystem(self.collisions, manager)
+        # Needs collisions handled after each axis is moved
+        self.resolves_position = bool(
+            self.collision_system
+            and self.collision_system.correct_position
+            in self.collision_system.handlers)
+
+        if self.manager.movement_engine is not None:
+            self.manager.movement_engine.add(self)
 
     def _move_horizontal(self, entity, movement, dt):
         vx = movement.velocity[0]
-        entity.component(Spatial).x += vx * dt
+        spatial = entity.component(Spatial)
+        x = spatial.x
+        spatial.x += vx * dt
         if self.collisions:
-            self.collision_system.handle_collisions(axis='x')
+            self.collision_system.handle_collisions(axis='x',
+                                                    dx=spatial.x - x)
 
     def _move_vertical(self, entity, movement, dt):
         try:
@@ -58,9 +78,12 @@ class MovementSystem(System):
         except:
             pass
         vy = movement.velocity[1]
-        entity.component(Spatial).y += vy * dt
+        spatial = entity.component(Spatial)
+        y = spatial.y
+        spatial.y += vy * dt
         if self.collisions:
-            self.collision_system.handle_collisions(axis='y')
+            self.collision_system.handle_collisions(axis='y',
+                                                    dy=spatial.y - y)
 
     def move(self, dt):
         entity = self.movement.entity
@@ -70,68 +93,120 @@ class MovementSystem(System):
         self._move_horizontal(entity, movement, dt)
 
     def update(self, dt):
-        self.move(dt)
+        if self.movement.body is None:
+            # Not managed by a movement engine
+            self.move(dt)
 
 
 class CollisionSystem(System):
     def __init__(self, collision_component, manager):
         super(CollisionSystem, self).__init__(manager)
-        self.manager.collidables.add(collision_component)
         self.entity = collision_component.entity
         entity = self.entity
         self.component = collision_component
-        if self.component.no_handlers:
-            self.handlers = []
-        else:
-            handlers = []
+        # Handlers that move the entity run while it moves, one
+        # axis at a time. Contact handlers run once per step, for
+        # each pair the SystemsManager's PairCache finds.
+        self.position_handlers = []
+        self.contact_handlers = []
+        if not self.component.no_handlers:
             if Hurt in entity.components:
-                handlers.append(self.deal_damage)
+                self.contact_handlers.append(self.deal_damage)
             if Push in entity.components:
-                handlers.append(self.push)
+                self.position_handlers.append(self.push)
             if (Movement in entity.components
                 and (Push not in entity.components
                      and Hurt not in entity.components)):
-                handlers.append(self.correct_position)
-            self.handlers = handlers
+                self.position_handlers.append(self.correct_position)
+        self.handlers = self.position_handlers + self.contact_handlers
         # Is child and therefor controlled by external system
         self.is_child = False
         # Set of usable Components
         # Will contain any Usable components colliding with entity
         # if entity has a Use component
         self.usable = set()
+        self.tracks_usable = bool(self.handlers
+                                  and Use in entity.components)
+        # Entities passed through by the last swept move,
+        # contacts for this step even if not overlapping anymore
+        self.passed = set()
 
-    def handle_collisions(self, axis='x'):
+    def handles_contacts(self):
+        return bool(self.contact_handlers or self.tracks_usable)
+
+    def handle_collisions(self, axis='x', dx=0, dy=0):
         """
-        Check and handle all collisions.
+        Check and handle collisions with position handlers.
+
+        dx, dy is how far the entity has just moved. If its
+        Collisions component is swept, everything it passed through
+        on the way is handled too, in the order it got there, so
+        fast entities don't skip over thin objects. Once a handler
+        stops it (e.g. correct_position), objects further along the
+        way are only handled if the entity still overlaps them.
+        Objects passed through also count as contacts for this step.
         """
-        if not self.handlers:
-            # No collision handlers, move along
+        swept = self.component.swept and (dx or dy)
+        collidables = self.manager.collidables
+        if not self.position_handlers:
+            if swept and self.handles_contacts():
+                self.passed.update(
+                    ob.entity
+                    for t, ob in collidables.objs_swept(self.entity, dx, dy))
+            return
+        if not swept:
+            for ob in collidables.objs_colliding(self.entity):
+                self.handle_collision(ob, axis=axis)
             return
-        cobs = self.manager.collidables.known_objs()
-        self.manager.collidables.clear()
-        for e in self.manager.systems:
+        spatial = self.entity.component(Spatial)
+        position = spatial.x, spatial.y
+        handled = set()
+        for t, ob in collidables.objs_swept(self.entity, dx, dy):
+            if (spatial.x, spatial.y) != position:
+                break
+            self.handle_collision(ob, axis=axis)
+            handled.add(ob)
+            self.passed.add(ob.entity)
+        else:
+            return
+        for ob in collidables.objs_colliding(self.entity):
+            if ob not in handled:
+                self.handle_collision(ob, axis=axis)
+
+    def begin_contact(self, other):
+        """
+        Called when entity starts overlapping other entity.
+        """
+        if self.tracks_usable:
             try:
-                self.manager.collidables.add(
-                    e.component(Collisions))
+                self.usable.add(other.component(Usable))
+            except KeyError:
+                pass
+        self.stay_contact(other)
+
+    def stay_contact(self, other):
+        """
+        Called each step entity overlaps other entity.
+        """
+        colliding_object = other.component(Collisions)
+        for h in self.contact_handlers:
+            h(self.entity, colliding_object)
+
+    def end_contact(self, other):
+        """
+        Called when entity stops overlapping other entity.
+        """
+        if self.tracks_usable:
+            try:
+                self.usable.discard(other.component(Usable))
             except KeyError:
                 pass
-            #self.manager.collidables.add(c)
-        self.usable.clear()
-        for ob in self.manager.collidables.objs_colliding(self.entity):
-            if Use in self.entity.components:
-                # Update the set of usables in range of entity
-                try:
-                    usable = ob.entity.component(Usable)
-                    self.usable.add(usable)
-                except KeyError:
-                    pass
-            self.handle_collision(ob, axis=axis)
 
     def handle_collision(self, colliding_object, axis='x'):
         # log.info('%s, %s',
         #          self.entity.component(Spatial).right,
         #          self.entity.component(Spatial).left)
-        for h in self.handlers:
+        for h in self.position_handlers:
             h(self.entity, colliding_object, axis=axis)
 
     def correct_position(self, entity, colliding_object, axis='x'):
@@ -230,15 +305,35 @@ class AttackSystem(System):
         self.collidables = collidables
 
     def attack(self, weapon):
-        log.info('ATTACKING')
+        if trace.enabled:
+            trace('ATTACKING')
+        e, systems = self.new_bullet(weapon)
+        self.manager.add_entities(e, systems=systems)
+        weapon.fire(e)
+
+    def new_bullet(self, weapon):
+        """
+        Return (bullet, systems) for a bullet of weapon, not added to
+        the manager yet. systems is None unless the bullet was taken
+        from the pool of the weapon and team.
+        """
+        team = None
+        if Team in self.entity.components:
+            team = self.entity.component(Team).name
+        pool = self.manager.pool((weapon, team))
+        pooled = pool.acquire()
+        if pooled is not None:
+            e, systems = pooled
+            self.reset_bullet(e)
+            return e, systems
         components = []
         if Team in self.entity.components:
             components.append(Team(
                 self.entity.component(Team).name))
         display = None
         for klass, kwargs in weapon.components:
-            log.info(klass)
-            log.info(kwargs)
+            if trace.enabled:
+                trace('%s %s', klass, kwargs)
             if klass == Display:
                 c = klass(**kwargs)
                 display = c
@@ -248,9 +343,23 @@ class AttackSystem(System):
                 c = klass(**kwargs)
             components.append(c)
         e = Entity(*components)
+        e.pool = pool
+        e.component(BulletController).weapon = weapon
         e.component(Spatial).center = self.entity.component(Spatial).center
-        self.manager.add_entities(e)
-        weapon.fire(e)
+        return e, None
+
+    def reset_bullet(self, bullet):
+        """
+        Put a bullet reused from the pool back in its starting state.
+        """
+        spatial = bullet.component(Spatial)
+        spatial.center = self.entity.component(Spatial).center
+        spatial.old = spatial.rect.copy()
+        del spatial.history[:]
+        movement = bullet.component(Movement)
+        movement.velocity = [0, 0]
+        movement.acceleration = [0, 0]
+        bullet.component(BulletController)._elapsed = 0
 
     def update(self, dt):
         weapon = self.entity.component(Inventory).equipped
@@ -275,6 +384,21 @@ class UseSystem(System):
             self.do_use()
 
 
+class AttachSystem(System):
+    """
+    Moves an attached entity with its target. Updated after
+    MovementSystem, so followers move in the same step as what
+    they're attached to.
+    """
+    def __init__(self, entity, manager):
+        super(AttachSystem, self).__init__(manager)
+        self.entity = entity
+        self.attach = entity.component(Attach)
+
+    def update(self, dt):
+        self.attach.follow()
+
+
 class PathSystem(System):
     """
     Generally use only one instance per level.
@@ -283,6 +407,12 @@ class PathSystem(System):
 
     Should be created after all entities have
     been added to the manager.
+
+    Edges are computed once per distinct player stats
+    (max_jump_x, max_jump_y), players with the same stats share them.
+    Static solid geometry is indexed once in generate_graph. Nodes on
+    moving platforms and edges near moving solids are refreshed by
+    update when they move.
     """
 
     def __init__(self, manager):
@@ -295,7 +425,40 @@ class PathSystem(System):
           }
         """
         self.nodes = {}
+        """
+        { node: {
+            (player.max_jump_x, player.max_jump_y): set([start nodes])
+            }
+          }
+        """
         self.reverse_edges = {}
+        # Nodes in the order they were added, the same for
+        # levels built the same way (see snapshot.py)
+        self.node_order = []
+        # node: (x, y) position the node's edges were computed for
+        self.node_positions = {}
+        self.node_index = pathgraph.NodeIndex()
+        self.geometry = pathgraph.StaticGeometry()
+        # Solid entities with a Movement component: box last graphed
+        self.moving_solids = {}
+        # Nodes attached to entities that can move
+        self.moving_nodes = []
+        # Player stats edges have been computed for
+        self.graphed_stats = set()
+        # (start, goal, stats): path, cleared when edges change
+        self.path_cache = LRUCache(config.PATH_CACHE_SIZE)
+        # (goal, stats): {node: next node towards goal},
+        # cleared when edges change
+        self.flow_fields = LRUCache(config.PATH_CACHE_SIZE)
+        # Bumped whenever edges change
+        self.graph_version = 0
+        # Unfinished searches of queued requests, see process_requests:
+        # ('path', start, goal, stats) or ('field', goal, stats):
+        # (pathgraph.PathSearch, graph_version it started at).
+        # Usually only the one running when time ran out
+        self.searches = LRUCache(8)
+        # Queued path requests, agent: goal
+        self.requests = OrderedDict()
 
     def _player_stats(self, player):
         """
@@ -307,6 +470,11 @@ class PathSystem(System):
             m = player.component(Movement)
             return (m.max_jump_x, m.max_jump_y)
 
+    def _box(self, entity):
+        s = entity.component(Spatial)
+        return (s.left, s.bottom, s.right, s.top,
+                tuple(entity.component(Collisions).solid_edges))
+
     def generate_nodes(self, entity):
         """
         Create pathnodes on top of given entity.
@@ -314,8 +482,7 @@ class PathSystem(System):
         spatial = entity.component(Spatial)
         if (Collisions not in entity.components
             or 'top' not in entity.component(Collisions).solid_edges):
-            self.nodes = []
-            return
+            return []
         nodes = []
         width = spatial.width
         xpos = spatial.left
@@ -334,166 +501,418 @@ class PathSystem(System):
             nodes += nodes2
         return nodes
 
-    def generate_graph(self):
-
-        for entity in self.manager.systems:
-            if Walkable not in entity.components:
+    def generate_geometry(self):
+        """
+        Index solid geometry edges are checked against.
+        Solids without a Movement component go in the static
+        geometry, others are checked at their current position.
+        """
+        static = []
+        self.moving_solids = {}
+        for entity in self.manager.query(Spatial, Collisions):
+            if not entity.component(Collisions).solid_edges:
                 continue
+            if Movement in entity.components:
+                self.moving_solids[entity] = self._box(entity)
+            else:
+                static.append(self._box(entity))
+        self.geometry = pathgraph.StaticGeometry(static)
+
+    def add_node(self, node):
+        position = (node[0], node[1])
+        self.nodes[node] = {}
+        self.reverse_edges[node] = {}
+        self.node_positions[node] = position
+        self.node_index.add(node, position[0])
+        self.node_order.append(node)
+        if Attach in node.components:
+            target = node.component(Attach).target.entity
+            if Movement in target.components:
+                self.moving_nodes.append(node)
+
+    def generate_graph(self, workers=None):
+        """
+        Create nodes on walkable entities and find their edges.
+        Edges are loaded from config.PATH_GRAPH_CACHE when the same
+        geometry, nodes and player stats were graphed before.
+
+        With more than one worker (default config.PATH_GRAPH_WORKERS)
+        edges are found in a process pool, if concurrent.futures is
+        available (a warning is logged if not). The graph is the same
+        either way.
+        """
+        if workers is None:
+            workers = config.PATH_GRAPH_WORKERS
+        self.generate_geometry()
+        order = []
+        for entity in self.manager.query(Walkable):
             for node in self.generate_nodes(entity):
-                self.nodes[node] = {}
-                self.reverse_edges[node] = set()
-        for player in self.manager.systems:
-            if PathFinding in player.components:
-
+                self.add_node(node)
+                order.append(node)
+        self.graphed_stats.update(
+            self._player_stats(player)
+            for player in self.manager.query(PathFinding))
+        path = self.graph_cache_path(order)
+        if path is not None and self.load_graph(path, order):
+            log.info('loaded %s nodes from %s', len(order), path)
+            return
+        if workers > 1 and futures is None:
+            log.warning('concurrent.futures not available, graphing '
+                        'in one process instead of %s', workers)
+            workers = 1
+        if workers > 1:
+            self.find_edges_parallel(order, workers)
+        else:
+            for stats in self.graphed_stats:
+                log.info('graphing %s nodes for %s',
+                         len(self.nodes), stats)
                 for node in self.nodes:
-                    log.info('graphing')
-                    edges = self.get_edges(node, player)
-                    self.set_edges(node, player, edges)
+                    self.set_edges(node, stats,
+                                   self.find_edges(node, stats))
+        if path is not None:
+            self.save_graph(path, order)
+
+    def find_edges_parallel(self, order, workers):
+        """
+        Find edges of all nodes in a pool of worker processes,
+        each given chunks of start nodes and a copy of the geometry.
+        """
+        all_stats = sorted(self.graphed_stats)
+        log.info('graphing %s nodes for %s in %s processes',
+                 len(order), all_stats, workers)
+        positions = [self.node_positions[node] for node in order]
+        boxes = self.geometry.boxes
+        moving = self.moving_solids.values()
+        key = pathgraph.graph_key(boxes + moving, positions, all_stats)
+        # A few chunks per worker, so none waits on a slow one
+        size = max(1, -(-len(order) // (workers*4)))
+        with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = [executor.submit(pathgraph.edges_for_starts,
+                                    key, positions, boxes, moving,
+                                    all_stats,
+                                    range(i, min(i+size, len(order))))
+                    for i in range(0, len(order), size)]
+            for job in jobs:
+                for start, stats, ends in job.result():
+                    self.set_edges(order[start], stats,
+                                   set(order[i] for i in ends))
+
+    def graph_cache_path(self, order):
+        """
+        Return the file edges between nodes in given order are
+        cached in, None if caching is off.
+        """
+        if not config.PATH_GRAPH_CACHE:
+            return None
+        boxes = self.geometry.boxes + self.moving_solids.values()
+        positions = [self.node_positions[node] for node in order]
+        key = pathgraph.graph_key(boxes, positions, self.graphed_stats)
+        return os.path.join(config.PATH_GRAPH_CACHE, key + '.graph')
+
+    def load_graph(self, path, order):
+        """
+        Set edges of nodes in given order from a cache file.
+        Return False if there is none or it doesn't fit the nodes.
+        """
+        cached = pathgraph.load_edges(path)
+        if (not isinstance(cached, dict)
+            or set(cached) != self.graphed_stats
+            or any(len(ends) != len(order) for ends in cached.values())):
+            return False
+        for stats, ends in cached.items():
+            for node, indexes in zip(order, ends):
+                self.set_edges(node, stats,
+                               set(order[i] for i in indexes))
+        return True
+
+    def save_graph(self, path, order):
+        index = dict((node, i) for i, node in enumerate(order))
+        edges = dict(
+            (stats, [[index[end] for end in self.nodes[node][stats]]
+                     for node in order])
+            for stats in self.graphed_stats)
+        try:
+            pathgraph.save_edges(path, edges,
+                                 config.PATH_GRAPH_CACHE_FILES)
+        except (IOError, OSError) as e:
+            log.warning('could not cache path graph: %s', e)
 
     def set_edges(self, start, player, edges):
         player = self._player_stats(player)
+        old_edges = self.nodes[start].get(player)
+        if edges == old_edges:
+            return
+        self.graph_version += 1
+        self.path_cache.clear()
+        self.flow_fields.clear()
+        reverse_edges = self.reverse_edges
+        for edge in old_edges or ():
+            reverse_edges[edge][player].discard(start)
         self.nodes[start][player] = edges
         for edge in edges:
-            self.reverse_edges[edge].add(start)
+            try:
+                reverse_edges[edge][player].add(start)
+            except KeyError:
+                reverse_edges[edge][player] = set([start])
 
-    def get_edges(self, start, player, refresh=False):
+    def find_edges(self, start, player):
         """
-        Get edges for given start using given player's
+        Compute edges for given start using given player's
         max jump attributes.
 
-        Checks for collisions between the two nodes
+        Checks for solid geometry between the two nodes
         to make sure there's a clear path.
         Return a set() of path nodes.
         """
-        log.info('getting edges from: %s, for player: %s',
-                 start, player)
-        all_nodes = self.nodes
-        m = player.component(Movement)
-        max_jump_x = m.max_jump_x
-        max_jump_y = m.max_jump_y
-        if (start in all_nodes
-            and (max_jump_x, max_jump_y) in all_nodes[start]
-            and not refresh):
-            # Return the previously existing nodes
-            return _edges(start, player)
-
-        reachable = set()
-        for n in all_nodes:
-            if n == start:
-                continue
-            if abs(n[0]-start[0]) > max_jump_x:
-                continue
-            if n[1]-start[1] > max_jump_y:
+        if isinstance(self.collidables, CollisionManagerNumpy):
+            # Holds every solid, static or moving, where it is now
+            return pathgraph.edges_from_arrays(
+                start, self.node_positions, self.node_index,
+                self._player_stats(player), self.collidables)
+        return pathgraph.edges_from(
+            start, self.node_positions, self.node_index,
+            self._player_stats(player), self.geometry,
+            self.moving_solids.values())
+
+    def get_edges(self, start, player, refresh=False):
+        """
+        Get edges for given start using given player's
+        max jump attributes.
+        Previously computed edges are returned unless refresh is True.
+        Return a set() of path nodes.
+        """
+        stats = self._player_stats(player)
+        if not refresh:
+            try:
+                return self.nodes[start][stats]
+            except KeyError:
+                pass
+        return self.find_edges(start, stats)
+
+    def _starts_near(self, rect, all_stats):
+        """
+        Return nodes that might have an edge through given
+        (left, bottom, right, top) rect.
+        """
+        reach_x = max(stats[0] for stats in all_stats)
+        reach_y = max(stats[1] for stats in all_stats)
+        positions = self.node_positions
+        return [node for node in
+                self.node_index.between(rect[0]-reach_x, rect[2]+reach_x)
+                if positions[node][1] >= rect[1]-reach_y]
+
+    def refresh_moved(self):
+        """
+        Recompute edges touched by nodes and solids that moved
+        at least config.PATH_REFRESH_DISTANCE since last graphed.
+        """
+        all_stats = self.graphed_stats
+        if not all_stats:
+            return
+        distance = config.PATH_REFRESH_DISTANCE
+        positions = self.node_positions
+        dirty = set()
+        for node in self.moving_nodes:
+            old = positions[node]
+            new = (node[0], node[1])
+            if (abs(new[0]-old[0]) < distance
+                and abs(new[1]-old[1]) < distance):
                 continue
-            reachable.add(n)
-
-        edges = set()
-
-        for r in reachable:
-            testity = Entity(
-                Spatial(width=abs(r[0]-start[0]), height=abs(r[1]-start[1])),
-                Collisions(no_handlers=True))
-            s = testity.component(Spatial)
-            log.info('width: %s, height: %s', s.width, s.height)
-            tcol = testity.component(Collisions)
-            if r[0] > start[0]:
-                # Edge is right of start
-                s.left = start[0]
-            elif r[0] < start[0]:
-                # Edge is left of start
-                s.left = r[0]
-            else:
-                # vertical line, what do?
-                s.left = start[0]
-            if r[1] > start[1]:
-                # Edge is above start
-                s.bottom = start[1]
-            elif r[1] < start[1]:
-                # Edge is below start
-                s.bottom = r[1]
-            else:
-                # Edge is level with start
-                s.bottom = start[1]
-            blocked = False
-            for cop in self.collidables.objs_colliding(testity):
-                if r[0] > start[0] and 'left' in cop.solid_edges:
-                    blocked = True
-                    break
-                if r[0] < start[0] and 'right' in cop.solid_edges:
-                    blocked = True
-                    break
-                if r[1] > start[1] and 'bottom' in cop.solid_edges:
-                    blocked = True
-                    break
-                if r[1] < start[1] and 'top' in cop.solid_edges:
-                    blocked = True
-                    break
-            if blocked:
+            positions[node] = new
+            self.node_index.move(node, old[0], new[0])
+            # The node itself, nodes that had an edge to it
+            # and nodes that may reach it now
+            dirty.add(node)
+            for starts in self.reverse_edges[node].values():
+                dirty.update(starts)
+            dirty.update(self._starts_near(new + new, all_stats))
+        for entity, old in self.moving_solids.items():
+            new = self._box(entity)
+            if (abs(new[0]-old[0]) < distance
+                and abs(new[1]-old[1]) < distance):
                 continue
-            else:
-                edges.add(r)
+            self.moving_solids[entity] = new
+            # Edges through either position may have changed
+            dirty.update(self._starts_near(
+                (min(old[0], new[0]), min(old[1], new[1]),
+                 max(old[2], new[2]), max(old[3], new[3])),
+                all_stats))
+        for node in dirty:
+            for stats in self.nodes[node].keys():
+                self.set_edges(node, stats, self.find_edges(node, stats))
+
+    def find_path(self, start, goal, player_stats):
+        """
+        Find the shortest path from start to goal node for a player
+        (or a (max_jump_x, max_jump_y) tuple) using A*.
+        Return a list of nodes from start to goal,
+        empty if goal can't be reached.
+
+        Recent paths are cached until edges change.
+        """
+        return self._find_path(start, goal, player_stats)
+
+    def _find_path(self, start, goal, player_stats, deadline=None):
+        """
+        find_path, but return None if deadline passes first.
+        The search goes on from where it stopped on the next call.
+        """
+        stats = self._player_stats(player_stats)
+        key = (start, goal, stats)
+        path = self.path_cache.get(key)
+        if path is None:
+            search = self._search(
+                ('path', start, goal, stats),
+                lambda: pathgraph.PathSearch(self.nodes, self.node_positions,
+                                             stats, start, goal))
+            if not search.run(deadline):
+                return None
+            path = tuple(reversed(search.chain(goal)))
+            if not path and trace.enabled:
+                trace('No available path from %s to %s', start, goal)
+            self._finished(('path', start, goal, stats), self.path_cache,
+                           key, path)
+        return list(path)
+
+    def flow_field(self, goal, player_stats):
+        """
+        Return a {node: next node} dict leading every node
+        that can reach goal along its shortest path there.
+        Found with a single Dijkstra search backwards from goal.
+        """
+        stats = self._player_stats(player_stats)
+        key = (goal, stats)
+        field = self.flow_fields.get(key)
+        if field is None:
+            search = self._field_search(goal, stats)
+            search.run()
+            field = search.came_from
+            self._finished(('field', goal, stats), self.flow_fields,
+                           key, field)
+        return field
+
+    def _field_search(self, goal, stats):
+        return self._search(
+            ('field', goal, stats),
+            lambda: pathgraph.PathSearch(self.reverse_edges,
+                                         self.node_positions, stats, goal))
+
+    def _field_path(self, start, goal, stats, deadline=None):
+        """
+        Return the path from start to goal along the flow field
+        of goal, or None if deadline passes first. Only as much
+        of the field as start needs is searched.
+        """
+        field = self.flow_fields.get((goal, stats))
+        if field is not None:
+            return self.follow_field(start, field)
+        search = self._field_search(goal, stats)
+        if not search.run(deadline, until=start):
+            return None
+        if search.finished:
+            self._finished(('field', goal, stats), self.flow_fields,
+                           (goal, stats), search.came_from)
+        return search.chain(start)
+
+    def _search(self, key, make):
+        """
+        Return the unfinished search of key, a new one from make()
+        if there is none or edges changed since it started.
+        """
+        entry = self.searches.get(key)
+        if entry is None or entry[1] != self.graph_version:
+            entry = (make(), self.graph_version)
+            self.searches.put(key, entry)
+        return entry[0]
 
-        return edges
+    def _finished(self, key, cache, cache_key, result):
+        """
+        Forget the finished search of key and put its result in cache.
+        """
+        self.searches.pop(key)
+        cache.put(cache_key, result)
 
-    def get_path(self, goal):
-        current_node = self.current_node
-        if not current_node or not goal:
+    def follow_field(self, start, field):
+        """
+        Return the path from start given by a flow field,
+        empty if start can't reach the field's goal.
+        """
+        if start not in field:
             return []
-        elif current_node == goal:
-            return [goal]
-        if not self.last_target_node:
-            self.last_target_node = goal
-        if goal.unreachable:
-            log.info('Goal unreachable: %s', goal)
-            return [current_node]
-        elif self.last_target_node == goal:
-            if self.destination not in self.current_node.get_edges(self):
-                pass
-            else:
-                log.info('Reusing last path: %s', self.path)
-                return self.path
-        else:
-            self.last_target_node = goal
-
-        start = current_node
-        frontier = PriorityQueue()
-        frontier.put(start, 0)
-        came_from = {}
-        cost_so_far = {}
-        came_from[start] = None
-        cost_so_far[start] = 0
-
-        while not frontier.empty():
-            current = frontier.get()
-            if current is goal:
-                break
-            # Get current node edges
-            for next in current.get_edges(self):
-                new_cost = cost_so_far[current] + current.cost(next)
-                if next not in cost_so_far or new_cost < cost_so_far[next]:
-                    cost_so_far[next] = new_cost
-                    priority = new_cost + self._heuristic(goal, next)
-                    frontier.put(next, priority)
-                    came_from[next] = current
         path = []
-        path.append(goal)
-        current = goal
-        while True:
-            try:
-                current = came_from[current]
-            except KeyError:
-                log.warning('No available path to %s', current)
-                current.unreachable = True
-                break
-            if not current:
-                break
-            path.append(current)
-        # Pop current node from path
-        path.pop()
+        node = start
+        while node is not None:
+            path.append(node)
+            node = field[node]
         return path
 
+    def nearest_node(self, entity):
+        """
+        Return the node closest to the bottom of given entity,
+        or None if there is none within config.NODE_SPACING.
+        """
+        position = entity.component(Spatial).midbottom
+        spacing = config.NODE_SPACING
+        nearest = None
+        nearest_distance = spacing
+        for node in self.node_index.between(position[0]-spacing,
+                                            position[0]+spacing):
+            d = distance(position, self.node_positions[node])
+            if d <= nearest_distance:
+                nearest, nearest_distance = node, d
+        return nearest
+
+    def request_path(self, agent, goal):
+        """
+        Queue a path search for agent, an entity with a PathFinding
+        component. Its PathFinding.path is replaced once found.
+        A newer request for the same agent replaces the queued one.
+        """
+        self.requests.pop(agent, None)
+        self.requests[agent] = goal
+
+    def process_requests(self, budget):
+        """
+        Answer queued path requests until budget seconds
+        have been spent, all of them if budget is None. Agents
+        sharing a goal and stats are answered together, from one
+        flow field when there are at least
+        config.FLOW_FIELD_MIN_AGENTS of them.
+        Searches still running when time is up go on from where
+        they stopped on later calls, so are the requests left over.
+        """
+        if not self.requests:
+            return
+        deadline = None if budget is None else time.time() + budget
+        groups = OrderedDict()
+        for agent, goal in self.requests.items():
+            key = (goal, self._player_stats(agent))
+            groups.setdefault(key, []).append(agent)
+        for (goal, stats), agents in groups.items():
+            if len(agents) >= config.FLOW_FIELD_MIN_AGENTS:
+                find = self._field_path
+            else:
+                find = self._find_path
+            for agent in agents:
+                if deadline is not None and time.time() >= deadline:
+                    return
+                start = self.nearest_node(agent)
+                if start is None:
+                    del self.requests[agent]
+                    if trace.enabled:
+                        trace('%s is not near any path node', agent)
+                    continue
+                path = find(start, goal, stats, deadline)
+                if path is None:
+                    # Out of time
+                    return
+                del self.requests[agent]
+                agent.component(PathFinding).path = path
+
     def draw_graph(self):
-        b = cocos.batch.BatchableNode()
+        if backend.HEADLESS or self.manager.layer is None:
+            return
+        b = backend.batch.BatchableNode()
         for node in self.nodes:
             players = self.nodes[node].keys()
             for edge in self.nodes[node][players[0]]:
@@ -503,62 +922,334 @@ class PathSystem(System):
                     color = rgba('green', 125)
                 else:
                     color = rgba('red', 125)
-                l = draw.Line(
+                l = backend.draw.Line(
                     (node[0], node[1]), (edge[0], edge[1]),
                     color, stroke_width=3)
                 b.add(l)
         self.manager.layer.add(b, z=4)
 
     def update(self, dt):
-        for node in self.nodes:
-            spatial = node.component(Spatial)
-            # TODO: Use reverse edges to update the edges
+        if self.moving_nodes or self.moving_solids:
+            self.refresh_moved()
+        self.process_requests(config.PATH_FRAME_BUDGET)
 
 
 class SystemsManager(object):
     """
     One per level/scene.
+    layer is the cocos layer sprites are added to,
+    None to not draw anything (e.g. when running headless).
     """
-    def __init__(self, collidables, layer):
-        # Entity: [systems]
+    # Systems are updated type by type, in this order.
+    # Types not listed here are updated after these,
+    # in the order they were first added.
+    system_order = (CollisionSystem, MovementSystem, AttachSystem,
+                    AttackSystem, UseSystem)
+    # (system type, component type an entity needs to get that system)
+    system_components = ((CollisionSystem, Collisions),
+                         (MovementSystem, Movement),
+                         (AttachSystem, Attach),
+                         (AttackSystem, Fighting),
+                         (UseSystem, Use))
+
+    def __init__(self, collidables, layer, movement_engine=None):
+        # Entity: {system type: system}
         self.systems = OrderedDict()
+        # System type: {entity: system}
+        self.systems_by_type = OrderedDict(
+            (system_type, OrderedDict()) for system_type in self.system_order)
+        # Requested system type: known system types that are
+        # subclasses of it, for get_system
+        self._subtypes = {}
+        # Entities grouped by their set of component types
+        self.archetypes = ArchetypeIndex()
+        # Kept in sync with every added entity that has
+        # a Collisions component
         self.collidables = collidables
+        # Same entities, for the contact pass at the end of each step
+        if isinstance(collidables, CollisionManagerNumpy):
+            self.pair_cache = PairCache(store=collidables)
+        else:
+            self.pair_cache = PairCache()
+        # Entity: its CollisionSystem, if it handles contacts
+        self.contact_systems = {}
+        # Entities skipped by step: static ones for good (see
+        # is_static), idle elevators and their followers until woken
+        self.sleeping = set()
+        # Awake entities that fall asleep once they come to rest
+        self.restless = set()
+        # Entity: entities attached to it, woken with it
+        self.followers = defaultdict(list)
+        # Cached awake_entities() and the query() list it came from
+        self._awake = []
+        self._awake_of = None
         self.layer = layer
         self.to_remove = set()
         self.pathfinding = None
+        # Optional physics.MovementEngine, moves all entities
+        # with a MovementSystem in one step each frame
+        self.movement_engine = movement_engine
+        # Spatial components moved this tick, their sprites
+        # and cshapes are synced once at the end of the tick
+        self.dirty_spatials = []
+        # Spatial components moved in the last tick,
+        # their sprites are interpolated
+        self.interpolated = []
+        # Fixed simulation step, see update
+        self.tick = 1.0/config.TICK_RATE
+        self.max_ticks = config.MAX_TICKS_PER_FRAME
+        # Frame time not simulated yet
+        self.accumulator = 0.0
+        # Pool key: util.Pool of removed (entity, systems) to reuse
+        self.pools = {}
+        # z: BatchNode in layer holding all sprites drawn at that z
+        self.batches = {}
+        # Optional profiler.FrameProfiler, times every frame when set
+        self.profiler = None
+        # Id given to the next added entity
+        self.next_id = 0
+        # Removed entities without a pool, kept for snapshot.restore
+        # while a snapshot is held: id: (entity, systems, removal
+        # number), in the order they were removed (see hold_removed)
+        self.removed = OrderedDict()
+        # Removal numbers at which held snapshots were saved, oldest
+        # first
+        self.holds = []
+        # Entities removed so far
+        self.removals = 0
 
     def get_system(self, entity, system_type):
-        for s in self.systems[entity]:
-            if isinstance(s, system_type):
-                return s
+        """
+        Return entity's system of given type or a subclass of it.
+        """
+        systems = self.systems.get(entity, {})
+        try:
+            return systems[system_type]
+        except KeyError:
+            pass
+        try:
+            subtypes = self._subtypes[system_type]
+        except KeyError:
+            subtypes = self._subtypes[system_type] = [
+                t for t in self.systems_by_type if issubclass(t, system_type)]
+        for subtype in subtypes:
+            if subtype in systems:
+                return systems[subtype]
         # No system of type, raise exception
         raise Exception('{} has no system of type {}'.format(
             entity, system_type))
 
-    def add_entities(self, *entities):
+    def get_systems(self, system_type):
+        """
+        Return a list of all systems of given type.
+        """
+        try:
+            return self.systems_by_type[system_type].values()
+        except KeyError:
+            return []
+
+    def add_system(self, entity, system):
+        """
+        Index system for given entity.
+        """
+        system_type = system.__class__
+        self.systems[entity][system_type] = system
+        if system_type is CollisionSystem and system.handles_contacts():
+            self.contact_systems[entity] = system
+        try:
+            self.systems_by_type[system_type][entity] = system
+        except KeyError:
+            self.systems_by_type[system_type] = OrderedDict(
+                [(entity, system)])
+            # A new type may be a subclass of any requested one
+            self._subtypes.clear()
+
+    def query(self, *component_types):
+        """
+        Return a list of entities having all given component types.
+        The list is cached, don't modify it.
+        """
+        return self.archetypes.query(*component_types)
+
+    def awake_entities(self):
+        """
+        Return a list of entities that aren't asleep.
+        The list is cached, don't modify it.
+        """
+        entities = self.query()
+        if entities is not self._awake_of:
+            sleeping = self.sleeping
+            self._awake = [e for e in entities if e not in sleeping]
+            self._awake_of = entities
+        return self._awake
+
+    def is_static(self, entity):
+        """
+        Whether entity never moves: it has no Movement, or it is
+        attached to an entity that has none (e.g. path nodes on
+        platforms).
+        """
+        components = entity.components
+        if Attach in components:
+            target = components[Attach].target.entity
+            return Movement not in target.components
+        return Movement not in components
+
+    def is_idle(self, entity):
+        """
+        Whether a restless entity can fall asleep: it didn't move in
+        the last step, its elevator isn't running and what it is
+        attached to is asleep.
+        """
+        components = entity.components
+        spatial = components[Spatial]
+        if spatial.rect.position != spatial.old.position:
+            return False
+        if (ElevatorController in components
+            and components[ElevatorController].is_running()):
+            return False
+        if (Attach in components
+            and components[Attach].target.entity not in self.sleeping):
+            return False
+        return True
+
+    def sleep(self, entity):
+        """
+        Stop updating entity until it is woken.
+        """
+        self.sleeping.add(entity)
+        self.restless.discard(entity)
+        self._awake_of = None
+        try:
+            system = self.systems[entity][MovementSystem]
+        except KeyError:
+            return
+        if system.movement.body is not None:
+            self.movement_engine.remove(system)
+
+    def wake(self, entity):
+        """
+        Resume updating a sleeping entity and its followers.
+        Static entities never wake.
+        """
+        if entity not in self.sleeping or self.is_static(entity):
+            return
+        self.sleeping.discard(entity)
+        self.restless.add(entity)
+        self._awake_of = None
+        try:
+            system = self.systems[entity][MovementSystem]
+        except KeyError:
+            pass
+        else:
+            if self.movement_engine is not None:
+                self.movement_engine.add(system)
+        for follower in self.followers.get(entity, ()):
+            self.wake(follower)
+
+    def fall_asleep(self):
+        """
+        Put restless entities that have come to rest to sleep.
+        """
+        for entity in list(self.restless):
+            if self.is_idle(entity):
+                self.sleep(entity)
+
+    def create_system(self, system_type, entity):
+        if system_type is CollisionSystem:
+            return CollisionSystem(entity.component(Collisions), self)
+        if system_type is AttackSystem:
+            return AttackSystem(entity, self.collidables, self)
+        return system_type(entity, self)
+
+    def _system_types(self, archetype):
+        """
+        Return system types needed by entities of given archetype.
+        """
+        try:
+            return archetype.data['system_types']
+        except KeyError:
+            system_types = [system_type for system_type, component_type
+                            in self.system_components
+                            if component_type in archetype.key]
+            archetype.data['system_types'] = system_types
+            return system_types
+
+    def add_entities(self, *entities, **kwargs):
         """
         Add entity to systems manager and
         create systems for it.
+
+        systems={system type: system} re-adds an entity taken from
+        a pool with the systems it had, instead of creating new ones.
+        keep_ids=True keeps the ids entities already have (e.g. ones
+        brought back by snapshot.restore).
         """
+        systems = kwargs.pop('systems', None)
+        keep_ids = kwargs.pop('keep_ids', False)
         for entity in entities:
-            self.systems[entity] = []
-            systems = self.systems[entity]
-            if Collisions in entity.components:
-                c = CollisionSystem(entity.component(Collisions), self)
-                systems.append(c)
-            if Movement in entity.components:
-                m = MovementSystem(entity, self)
-                systems.append(m)
-            if Fighting in entity.components:
-                a = AttackSystem(entity, self.collidables, self)
-                systems.append(a)
-            if Use in entity.components:
-                systems.append(UseSystem(entity, self))
-            if Display in entity.components:
-                self.layer.add(entity.component(Display).sprite,
-                               z=entity.component(Display).z)
+            if not keep_ids or entity.id is None:
+                # New one even for pooled entities, ids in use are
+                # always below next_id (see snapshot.py)
+                entity.id = self.next_id
+                self.next_id += 1
+            self.systems[entity] = {}
+            archetype = self.archetypes.add(entity)
+            if Collisions in archetype.key:
+                self.collidables.add(entity)
+            if systems is not None:
+                for system in systems.values():
+                    self.add_system(entity, system)
+                    if (isinstance(system, MovementSystem)
+                        and self.movement_engine is not None):
+                        self.movement_engine.add(system)
+                if Display in archetype.key:
+                    # Sprite stayed in layer while pooled
+                    entity.component(Display).sprite.visible = True
+            else:
+                for system_type in self._system_types(archetype):
+                    self.add_system(entity,
+                                    self.create_system(system_type, entity))
+                if Display in archetype.key and self.layer is not None:
+                    display = entity.component(Display)
+                    self.batch(display.z).add(display.sprite)
+            static = self.is_static(entity)
+            if Collisions in archetype.key:
+                self.pair_cache.add(
+                    entity,
+                    static=static and entity not in self.contact_systems)
+            if static:
+                self.sleep(entity)
+            elif (ElevatorController in archetype.key
+                  or Attach in archetype.key):
+                self.restless.add(entity)
+            if Attach in archetype.key:
+                target = entity.component(Attach).target.entity
+                self.followers[target].append(entity)
             entity.systems_manager = self
 
+    def batch(self, z):
+        """
+        Return the BatchNode sprites at given z are drawn with.
+        """
+        try:
+            return self.batches[z]
+        except KeyError:
+            node = self.batches[z] = backend.BatchNode()
+            self.layer.add(node, z=z)
+            return node
+
+    def pool(self, key):
+        """
+        Return the pool of removed entities for given key,
+        e.g. bullets of one weapon.
+        """
+        try:
+            return self.pools[key]
+        except KeyError:
+            pool = self.pools[key] = Pool(config.BULLET_POOL_SIZE)
+            return pool
+
     def remove(self, entity):
         """
         Schedules an entity to be removed
@@ -566,22 +1257,222 @@ class SystemsManager(object):
         """
         self.to_remove.add(entity)
 
+    def component_added(self, entity, component):
+        """
+        Called by entity when a component is added to it.
+        """
+        if entity not in self.systems:
+            return
+        self.archetypes.component_added(entity, component.add_as)
+        if component.add_as is Collisions:
+            self.collidables.add(entity)
+            self.pair_cache.add(entity)
+
+    def component_removed(self, entity, component):
+        """
+        Called by entity when a component is removed from it.
+        """
+        if entity not in self.systems:
+            return
+        self.archetypes.component_removed(entity, component.add_as)
+        if (component.add_as is Collisions
+            and self.collidables.is_known(entity)):
+            self.collidables.remove(entity)
+            self.pair_cache.remove(entity)
+
     def update(self, dt):
-        if dt > 1.0/25:
-            # slow game down if fps drops too low
-            # so collisions don't get messed up
-            dt = 1.0/30
-        # Update all components and systems
-        for entity in self.systems.keys():
+        """
+        Advance the simulation by dt seconds of frame time.
+
+        The simulation runs in fixed steps of self.tick, as many as fit
+        in the time accumulated so far but no more than self.max_ticks
+        (time beyond that is dropped, the game slows down). Sprites
+        of entities that moved in the last step are drawn between their
+        last two positions, by how far the leftover time is into the
+        next step.
+        """
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.begin_frame()
+        self.accumulator += dt
+        ticks = 0
+        while self.accumulator >= self.tick and ticks < self.max_ticks:
+            self.step(self.tick)
+            self.accumulator -= self.tick
+            ticks += 1
+        if ticks == self.max_ticks:
+            self.accumulator %= self.tick
+        if self.pathfinding is not None:
+            if profiler is not None:
+                start = profiler.clock()
+                self.pathfinding.update(dt)
+                profiler.add(PathSystem, profiler.clock() - start,
+                             1, len(self.pathfinding.requests))
+            else:
+                self.pathfinding.update(dt)
+        alpha = self.accumulator / self.tick
+        for spatial in self.interpolated:
+            spatial.interpolate(alpha)
+        if profiler is not None:
+            profiler.end_frame()
+
+    def step(self, dt):
+        """
+        Run one simulation step of dt seconds.
+        """
+        profiler = self.profiler
+        lap = None
+        if profiler is not None:
+            lap = profiler.lap
+            profiler.mark()
+        # Update all components, then systems type by type,
+        # of entities that aren't asleep
+        sleeping = self.sleeping
+        for entity in self.awake_entities():
             for component in entity.components.values():
                 component.update(dt)
-            for system in self.systems[entity]:
-                system.update(dt)
+                if lap is not None:
+                    lap(component.__class__)
+        for system_type, systems in self.systems_by_type.items():
+            engine = self.movement_engine
+            if system_type is MovementSystem and engine is not None:
+                engine.step(dt)
+                if lap is not None:
+                    lap(engine.__class__, 1, engine.count)
+            updated = 0
+            # items() is a copy, systems may add entities
+            # (e.g. bullets)
+            for entity, system in systems.items():
+                if entity not in sleeping:
+                    system.update(dt)
+                    updated += 1
+            if lap is not None:
+                lap(system_type, updated, updated)
+        self.handle_contacts()
+        if lap is not None:
+            lap(PairCache, 1, len(self.pair_cache.entries))
+        if self.restless:
+            self.fall_asleep()
+        # Entities that stopped moving are drawn where they are
+        for spatial in self.interpolated:
+            if not spatial._dirty:
+                spatial.interpolate(1)
+        for spatial in self.dirty_spatials:
+            spatial.sync()
+        self.interpolated, self.dirty_spatials = self.dirty_spatials, []
+        self.process_removals()
+
+    def process_removals(self):
+        """
+        Remove entities scheduled with remove.
+        """
         while self.to_remove:
             torm = self.to_remove.pop()
-            del self.systems[torm]
+            self.archetypes.remove(torm)
+            systems = self.systems.pop(torm)
+            for system_type in systems:
+                system = self.systems_by_type[system_type].pop(torm)
+                if (system_type is MovementSystem
+                    and system.movement.body is not None):
+                    self.movement_engine.remove(system)
+            self.contact_systems.pop(torm, None)
+            self.sleeping.discard(torm)
+            self.restless.discard(torm)
+            self.followers.pop(torm, None)
+            if Attach in torm.components:
+                target = torm.component(Attach).target.entity
+                try:
+                    self.followers[target].remove(torm)
+                except ValueError:
+                    pass
+            if self.collidables.is_known(torm):
+                self.collidables.remove(torm)
+                self.pair_cache.remove(torm)
+            self.removals += 1
+            if torm.pool is not None:
+                kept = torm.pool.release((torm, systems))
+            elif self.holds:
+                self.removed[torm.id] = (torm, systems, self.removals)
+                kept = True
+            else:
+                kept = False
+            if kept:
+                # Sprite is hidden instead of killed
+                torm.systems_manager = None
+                if Display in torm.components:
+                    torm.component(Display).sprite.visible = False
+                continue
             try:
                 torm.component(Display).sprite.kill()
             except KeyError:
                 # No display component, move along
                 pass
+
+    def hold_removed(self):
+        """
+        Keep entities removed from now on, for a snapshot being saved,
+        until release_removed is called with the returned number
+        (see snapshot.Hold).
+        """
+        self.holds.append(self.removals)
+        return self.removals
+
+    def release_removed(self, number):
+        """
+        Drop the hold of hold_removed that returned number and stop
+        keeping removed entities that no other hold needs.
+        """
+        self.holds.remove(number)
+        removed = self.removed
+        while removed:
+            entity_id = next(iter(removed))
+            entity, systems, removal = removed[entity_id]
+            if self.holds and removal > self.holds[0]:
+                break
+            del removed[entity_id]
+            if Display in entity.components:
+                entity.component(Display).sprite.kill()
+
+    def sort_by_id(self, entities):
+        """
+        Put given entities, added again with their old ids,
+        back in the order they were first added in (by id).
+        """
+        by_id = lambda entity: entity.id
+        system_types = set()
+        archetypes = set()
+        for entity in entities:
+            system_types.update(self.systems[entity])
+            archetypes.add(self.archetypes.archetype(entity))
+        sort_ordered(self.systems, by_id)
+        for system_type in system_types:
+            sort_ordered(self.systems_by_type[system_type], by_id)
+        for archetype in archetypes:
+            archetype.sort(by_id)
+
+    def handle_contacts(self):
+        """
+        Find the pairs of overlapping entities where one handles
+        contacts, and tell their CollisionSystems which contacts
+        began, stayed and ended this step.
+        """
+        contact_systems = self.contact_systems
+        passed = []
+        for entity, system in contact_systems.iteritems():
+            if system.passed:
+                for other in system.passed:
+                    if id(entity) < id(other):
+                        passed.append((entity, other))
+                    else:
+                        passed.append((other, entity))
+                system.passed.clear()
+        began, stayed, ended = self.pair_cache.update(contact_systems,
+                                                      passed)
+        for pairs, handle in ((ended, CollisionSystem.end_contact),
+                              (began, CollisionSystem.begin_contact),
+                              (stayed, CollisionSystem.stay_contact)):
+            for a, b in pairs:
+                if a in contact_systems:
+                    handle(contact_systems[a], b)
+                if b in contact_systems:
+                    handle(contact_systems[b], a)
@@ -0,0 +1,4 @@
+"""
+Tests for compy. Run from the repository root:
+    python -m unittest discover tests
+"""
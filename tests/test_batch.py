@@ -0,0 +1,56 @@
+import multiprocessing
+import unittest
+
+import batch
+import config
+
+
+def spin():
+    while True:
+        pass
+
+
+class RunBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        # Workers inherit it, a budget most frames run out of
+        self.budget = config.PATH_FRAME_BUDGET
+        config.PATH_FRAME_BUDGET = 0.0005
+
+    def tearDown(self):
+        config.PATH_FRAME_BUDGET = self.budget
+
+    def run_worlds(self, specs, workers):
+        """
+        Return {world index: [(tick, metrics)]} of a batch run.
+        """
+        results = {}
+        for index, tick, metrics in batch.run_batch(specs, 60, workers,
+                                                    every=30):
+            results.setdefault(index, []).append((tick, metrics))
+        return results
+
+    def test_same_metrics_alone_and_on_loaded_pool(self):
+        specs = batch.make_specs('stress', base_seed=1, repeats=4,
+                                 level_kwargs={'platforms': 60,
+                                               'ai_players': 30})
+        alone = self.run_worlds(specs[:1], 1)
+        # More worlds than workers, and other processes
+        # competing for the CPU
+        loaders = [multiprocessing.Process(target=spin)
+                   for i in range(multiprocessing.cpu_count() + 1)]
+        for loader in loaders:
+            loader.daemon = True
+            loader.start()
+        try:
+            loaded = self.run_worlds(specs, 2)
+        finally:
+            for loader in loaders:
+                loader.terminate()
+                loader.join()
+        self.assertEqual(len(alone[0]), 2)
+        self.assertEqual(alone[0], loaded[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Tracing for code that runs every frame.
+
+Logging formats messages and writes them to every handler on the
+calling thread, which is too slow to do inside a frame. A Tracer only
+appends (time, message, args) to an in-memory ring buffer; a
+background thread started with start() formats the records and passes
+them to the 'compy.trace' logger.
+
+    trace = Tracer('component')
+
+    if trace.enabled:
+        trace('health after damage: %s', self.amount)
+
+Checking enabled first skips building the arguments as well when
+tracing is off (config.TRACE). Arguments are formatted later on the
+flush thread, only pass values that won't change in the meantime.
+When the buffer is full the oldest records are dropped.
+"""
+import atexit
+import collections
+import logging
+import threading
+import time
+
+import config
+
+log = logging.getLogger('compy.trace')
+
+# (time, source, message, args) records waiting to be flushed
+records = collections.deque(maxlen=config.TRACE_BUFFER_SIZE)
+# Records dropped because the buffer was full
+dropped = 0
+
+
+class Tracer(object):
+    """
+    Records trace messages from one source, usually a module.
+    """
+    def __init__(self, source, enabled=None):
+        self.source = source
+        if enabled is None:
+            enabled = config.TRACE
+        self.enabled = enabled
+
+    def __call__(self, message, *args):
+        global dropped
+        if len(records) == records.maxlen:
+            dropped += 1
+        records.append((time.time(), self.source, message, args))
+
+
+def flush():
+    """
+    Pass all buffered records to the 'compy.trace' logger.
+    """
+    while records:
+        try:
+            created, source, message, args = records.popleft()
+        except IndexError:
+            # Emptied by another thread
+            return
+        if not log.isEnabledFor(logging.INFO):
+            continue
+        record = log.makeRecord(log.name, logging.INFO, source, 0,
+                                message, args, None)
+        record.created = created
+        record.msecs = (created - int(created)) * 1000
+        record.module = source
+        log.handle(record)
+
+
+class _Flusher(threading.Thread):
+    def __init__(self, interval):
+        super(_Flusher, self).__init__(name='trace-flush')
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            flush()
+        flush()
+
+
+_flusher = None
+
+
+def start(interval=None):
+    """
+    Start flushing records every interval seconds
+    (config.TRACE_FLUSH_INTERVAL) from a background thread.
+    """
+    global _flusher
+    if _flusher is not None:
+        return
+    _flusher = _Flusher(interval or config.TRACE_FLUSH_INTERVAL)
+    _flusher.start()
+    atexit.register(stop)
+
+
+def stop():
+    """
+    Stop the background thread, flushing what's left.
+    """
+    global _flusher
+    if _flusher is None:
+        return
+    _flusher.stopped.set()
+    _flusher.join()
+    _flusher = None
@@ -1,6 +1,7 @@
 import math
 import collections
 import heapq
+import itertools
 from webcolors import name_to_rgb as rgb
 
 
@@ -44,3 +45,102 @@ class PriorityQueue:
 
     def get(self):
         return heapq.heappop(self.elements)[1]
+
+
+class LRUCache:
+    """
+    Mapping that keeps at most maxsize items,
+    dropping the least recently used one first.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # Re-insert as most recently used
+        self.items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def clear(self):
+        self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+def sort_ordered(d, key):
+    """
+    Sort OrderedDict d by key(dict key) in place. Only the entries
+    from the first one out of order on are moved, so a few entries
+    appended out of order are cheap to put in place.
+    """
+    keys = [key(k) for k in d]
+    lowest = None
+    start = len(keys)
+    for i in xrange(len(keys)-1, -1, -1):
+        if lowest is not None and keys[i] > lowest:
+            start = i
+        if lowest is None or keys[i] < lowest:
+            lowest = keys[i]
+    if start == len(keys):
+        return
+    items = list(itertools.islice(d.iteritems(), start, None))
+    for k, _ in items:
+        del d[k]
+    items.sort(key=lambda item: key(item[0]))
+    d.update(items)
+
+
+class Pool:
+    """
+    Keeps released objects for reuse, at most maxsize of them.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.items = []
+        # Acquires answered from the pool / that found it empty
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, default=None):
+        """
+        Return a released object, or default if there are none.
+        """
+        if self.items:
+            self.hits += 1
+            return self.items.pop()
+        self.misses += 1
+        return default
+
+    def release(self, item):
+        """
+        Keep item for reuse.
+        Return False if the pool is full and item wasn't kept.
+        """
+        if len(self.items) >= self.maxsize:
+            return False
+        self.items.append(item)
+        return True
+
+    def clear(self):
+        del self.items[:]
+
+    def __len__(self):
+        return len(self.items)